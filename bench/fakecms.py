@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+""" A local stand-in for the xibo-cms XMDS soap service.
+
+Serves the WSDL, RegisterDisplay, RequiredFiles (with N synthetic media files,
+one layout and its resources), Schedule, chunked GetFile, GetResource and
+SubmitStats, with configurable latency, bandwidth and failure injection.
+
+    bench/fakecms.py --port 8000 --files 100 --size 1048576
+"""
+import SocketServer
+import argparse
+import base64
+import hashlib
+import logging
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+log = logging.getLogger('xiboside.fakecms')
+
+NS = 'urn:xmds'
+OPERATIONS = (
+    ('RegisterDisplay', ('serverKey', 'hardwareKey', 'displayName', 'clientType', 'clientVersion',
+                         'clientCode', 'operatingSystem', 'macAddress', 'xmrChannel', 'xmrPubKey'),
+     'ActivationMessage', 'string'),
+    ('RequiredFiles', ('serverKey', 'hardwareKey'), 'RequiredFilesXml', 'string'),
+    ('Schedule', ('serverKey', 'hardwareKey'), 'ScheduleXml', 'string'),
+    ('GetFile', ('serverKey', 'hardwareKey', 'fileId', 'fileType', 'chunkOffset', 'chuckSize'),
+     'file', 'base64Binary'),
+    ('GetResource', ('serverKey', 'hardwareKey', 'layoutId', 'regionId', 'mediaId'), 'resource', 'string'),
+    ('SubmitStats', ('serverKey', 'hardwareKey', 'statXml'), 'success', 'boolean'),
+)
+
+
+def wsdl(location, version=4):
+    messages = []
+    port_ops = []
+    binding_ops = []
+    for name, params, result, result_type in OPERATIONS:
+        if 'RegisterDisplay' == name and version < 5:
+            params = params[:-2]
+        parts = ''.join('<part name="%s" type="xsd:string"/>' % p for p in params)
+        messages.append('<message name="%sRequest">%s</message>' % (name, parts))
+        messages.append('<message name="%sResponse"><part name="%s" type="xsd:%s"/></message>'
+                        % (name, result, result_type))
+        port_ops.append('<operation name="%s"><input message="tns:%sRequest"/>'
+                        '<output message="tns:%sResponse"/></operation>' % (name, name, name))
+        body = '<soap:body use="encoded" namespace="%s" ' \
+               'encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"/>' % NS
+        binding_ops.append('<operation name="%s"><soap:operation soapAction="%s#%s" style="rpc"/>'
+                           '<input>%s</input><output>%s</output></operation>' % (name, NS, name, body, body))
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<definitions xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+        'xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:tns="%(ns)s" xmlns="http://schemas.xmlsoap.org/wsdl/" targetNamespace="%(ns)s">'
+        '%(messages)s'
+        '<portType name="xmdsPortType">%(port_ops)s</portType>'
+        '<binding name="xmdsBinding" type="tns:xmdsPortType">'
+        '<soap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>%(binding_ops)s</binding>'
+        '<service name="xmds"><port name="xmdsPort" binding="tns:xmdsBinding">'
+        '<soap:address location="%(location)s"/></port></service>'
+        '</definitions>'
+    ) % {
+        'ns': NS, 'location': location, 'messages': ''.join(messages),
+        'port_ops': ''.join(port_ops), 'binding_ops': ''.join(binding_ops)
+    }
+
+
+class Content:
+    """ Deterministic synthetic content: N media files, a layout and its resources. """
+    layout_id = '1'
+
+    def __init__(self, files=10, size=1024 * 1024, resources=2, seed=0):
+        self.media = {}
+        rnd = random.Random(seed)
+        block = ''.join(chr(rnd.randint(0, 255)) for _ in range(64 * 1024))
+        for i in range(files):
+            head = 'xiboside-fakecms-%d-' % i
+            data = (head + block * (size / len(block) + 1))[:size]
+            self.media[str(100 + i)] = ('%d.bin' % (100 + i), data)
+        self.resources = [('r1', 'm%d' % i) for i in range(resources)]
+        self.layout = self._layout()
+
+    def _layout(self):
+        media = ''.join(
+            '<media id="%s" type="text" duration="10" render="html"><options/><raw/></media>' % m
+            for r, m in self.resources
+        )
+        return (
+            '<?xml version="1.0"?><layout width="1920" height="1080" bgcolor="#000000">'
+            '<region id="r1" width="1920" height="1080" top="0" left="0">'
+            '<options><loop>1</loop></options>%s</region></layout>' % media
+        )
+
+    def required_files(self):
+        files = []
+        for fid, (path, data) in sorted(self.media.items()):
+            files.append('<file type="media" id="%s" size="%d" md5="%s" download="xmds" path="%s"/>'
+                         % (fid, len(data), hashlib.md5(data).hexdigest(), path))
+        files.append('<file type="layout" id="%s" size="%d" md5="%s" download="xmds" path="%s"/>'
+                     % (self.layout_id, len(self.layout), hashlib.md5(self.layout).hexdigest(), self.layout_id))
+        for region_id, media_id in self.resources:
+            files.append('<file type="resource" id="%d" layoutid="%s" regionid="%s" mediaid="%s" updated="0"/>'
+                         % (time.time(), self.layout_id, region_id, media_id))
+        # one entry per line, like the CMS does
+        return '<files>\n%s\n</files>' % '\n'.join(files)
+
+    def schedule(self):
+        return '<schedule><default file="%s"/></schedule>' % self.layout_id
+
+    def file(self, file_id, file_type):
+        if 'layout' == file_type and self.layout_id == file_id:
+            return self.layout
+        return self.media.get(file_id, ('', None))[1]
+
+    def resource(self, layout_id, region_id, media_id):
+        return '<html><body>%s %s %s</body></html>' % (layout_id, region_id, media_id)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+    def do_GET(self):
+        if not self.path.startswith('/xmds.php'):
+            return self.send_error(404)
+        version = 5 if 'v=5' in self.path else 4
+        host = self.headers.get('Host') or '%s:%d' % self.server.server_address
+        self._send(200, 'text/xml', wsdl('http://%s/xmds.php?v=%d' % (host, version), version))
+
+    def do_POST(self):
+        cms = self.server.cms
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        cms.requests += 1
+        if cms.latency:
+            time.sleep(cms.latency)
+
+        try:
+            name, params = self._parse(body)
+        except (ElementTree.ParseError, IndexError):
+            return self._fault('Client', 'Malformed request')
+
+        if name in ('GetFile', 'GetResource') and random.random() < cms.failure_rate:
+            cms.failures += 1
+            return self._fault('Server', 'Injected failure')
+
+        handler = getattr(self, '_op_' + name, None)
+        if handler is None:
+            return self._fault('Client', 'Unknown operation %s' % name)
+        result, result_type = handler(cms.content, params)
+        self._respond(name, result, result_type)
+
+    @staticmethod
+    def _parse(body):
+        root = ElementTree.fromstring(body)
+        envelope_body = [c for c in root if c.tag.endswith('}Body') or c.tag == 'Body'][0]
+        call = list(envelope_body)[0]
+        params = dict((c.tag.split('}')[-1], c.text or '') for c in call)
+        return call.tag.split('}')[-1], params
+
+    @staticmethod
+    def _op_RegisterDisplay(content, params):
+        return ('<display status="0" code="READY" message="Display is active and ready to start.">'
+                '<collectInterval>%d</collectInterval></display>' % 3600), 'string'
+
+    @staticmethod
+    def _op_RequiredFiles(content, params):
+        return content.required_files(), 'string'
+
+    @staticmethod
+    def _op_Schedule(content, params):
+        return content.schedule(), 'string'
+
+    @staticmethod
+    def _op_GetFile(content, params):
+        data = content.file(params.get('fileId'), params.get('fileType')) or ''
+        offset = int(float(params.get('chunkOffset') or 0))
+        size = int(float(params.get('chuckSize') or len(data)))
+        return base64.encodestring(data[offset:offset + size]), 'base64Binary'
+
+    @staticmethod
+    def _op_GetResource(content, params):
+        return content.resource(params.get('layoutId'), params.get('regionId'), params.get('mediaId')), 'string'
+
+    @staticmethod
+    def _op_SubmitStats(content, params):
+        return 'true', 'boolean'
+
+    def _respond(self, name, result, result_type):
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" '
+            'xmlns:ns1="%s" xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+            '<SOAP-ENV:Body><ns1:%sResponse><result xsi:type="xsd:%s">%s</result></ns1:%sResponse>'
+            '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+        ) % (NS, name, result_type, escape(result), name)
+        self._send(200, 'text/xml; charset=utf-8', xml)
+
+    def _fault(self, code, message):
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body>'
+            '<SOAP-ENV:Fault><faultcode>SOAP-ENV:%s</faultcode><faultstring>%s</faultstring></SOAP-ENV:Fault>'
+            '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+        ) % (code, escape(message))
+        self._send(500, 'text/xml; charset=utf-8', xml)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.cms.sent += len(body)
+        bandwidth = self.server.cms.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # throttle in 64k slices
+        step = 64 * 1024
+        for offset in range(0, len(body), step):
+            started = time.time()
+            chunk = body[offset:offset + step]
+            self.wfile.write(chunk)
+            delay = len(chunk) / float(bandwidth) - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class _Server(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeCms(threading.Thread):
+    """ Run the fake CMS in a background thread, see url once started. """
+    def __init__(self, host='127.0.0.1', port=0, content=None, latency=0.0, bandwidth=0, failure_rate=0.0):
+        super(FakeCms, self).__init__(name='fakecms')
+        self.daemon = True
+        self.content = content or Content()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.sent = 0
+        self._server = _Server((host, port), _Handler)
+        self._server.cms = self
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake xibo-cms XMDS service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--files', type=int, default=10, help="number of synthetic media files")
+    parser.add_argument('--size', type=int, default=1024 * 1024, help="size of each media file, bytes")
+    parser.add_argument('--resources', type=int, default=2, help="number of layout resources")
+    parser.add_argument('--latency', type=float, default=0.0, help="added per request, seconds")
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes per second per response, 0 is unlimited")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="GetFile/GetResource fault ratio")
+    args = parser.parse_args()
+
+    cms = FakeCms(args.host, args.port, Content(args.files, args.size, args.resources),
+                  args.latency, args.bandwidth, args.failure_rate)
+    print 'Serving %s/xmds.php' % cms.url
+    try:
+        cms.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
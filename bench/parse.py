@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+""" Microbenchmarks of the pure Python hot paths, no Qt needed.
+
+xlf.Xlf.parse, RequiredFilesResponse.parse (and its regex),
+ScheduleResponse.parse, util.md5sum_match and the schedule evaluation loop of
+XmdsThread.__xmds_cycle, on synthetic inputs of 10 to 100k elements.
+Results are JSON, tagged with the git commit, and can be compared:
+
+    bench/parse.py -o before.json
+    bench/parse.py --compare before.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import util
+import xlf
+import xmds
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+SIZES = (10, 100, 1000, 10000, 100000)
+
+
+def make_xlf(n):
+    """ n media, spread over regions of 10 media each. """
+    regions = []
+    for r in range(max(1, n / 10)):
+        media = ''.join(
+            '<media id="m%d_%d" type="image" duration="10" render="native">'
+            '<options><uri>%d.jpg</uri></options><raw/></media>' % (r, m, m)
+            for m in range(min(10, n))
+        )
+        regions.append('<region id="r%d" width="640" height="360" top="%d" left="0">'
+                       '<options><loop>1</loop></options>%s</region>' % (r, r, media))
+    return '<layout width="1920" height="1080" bgcolor="#000000">%s</layout>' % ''.join(regions)
+
+
+def make_required_files(n):
+    files = []
+    for i in range(n):
+        if i % 4:
+            files.append('<file type="media" id="%d" size="1024" md5="%s" download="xmds" path="%d.jpg"/>'
+                         % (i, hashlib.md5(str(i)).hexdigest(), i))
+        else:
+            files.append('<file type="resource" id="%d" layoutid="1" regionid="r%d" mediaid="m%d" updated="0"/>'
+                         % (i, i, i))
+    return '<files>\n%s\n</files>' % '\n'.join(files)
+
+
+def make_schedule(n):
+    layouts = ''.join(
+        '<layout file="%d" fromdt="2016-01-01 00:00:00" todt="2016-12-31 23:59:59" scheduleid="%d" priority="0"/>'
+        % (i, i) for i in range(n)
+    )
+    return '<schedule><default file="1"/>%s</schedule>' % layouts
+
+
+def evaluate_schedule(schedule, now):
+    # the loop of XmdsThread.__xmds_cycle, without the early break
+    found = None
+    for layout in schedule.layouts:
+        from_time = util.str_to_epoch(layout.fromdt, TIME_FMT, 0)
+        to_time = util.str_to_epoch(layout.todt, TIME_FMT, 0)
+        if from_time <= now <= to_time and found is None:
+            found = layout
+    return found
+
+
+def measure(func, min_time=0.2, rounds=5):
+    """ Best and median seconds per call over a few rounds of repeated calls. """
+    loops = 1
+    while True:
+        started = time.time()
+        for _ in xrange(loops):
+            func()
+        if time.time() - started >= min_time / rounds or loops >= 1 << 20:
+            break
+        loops *= 2
+
+    timings = []
+    for _ in range(rounds):
+        started = time.time()
+        for _ in xrange(loops):
+            func()
+        timings.append((time.time() - started) / loops)
+    timings.sort()
+    return timings[0], timings[len(timings) / 2]
+
+
+def benchmarks(n, work_dir):
+    xlf_path = os.path.join(work_dir, 'layout-%d.xml' % n)
+    with open(xlf_path, 'w') as f:
+        f.write(make_xlf(n))
+    rf_text = make_required_files(n)
+    sched_text = make_schedule(n)
+    schedule = xmds.ScheduleResponse()
+    schedule.parse(sched_text)
+
+    # md5sum_match is scaled in KiB
+    md5_path = os.path.join(work_dir, 'file-%d.bin' % n)
+    with open(md5_path, 'wb') as f:
+        f.write(os.urandom(1024) * n)
+    with open(md5_path, 'rb') as f:
+        md5sum = hashlib.md5(f.read()).hexdigest()
+
+    now = util.str_to_epoch('2016-06-01 00:00:00', TIME_FMT, 0)
+    return [
+        ('xlf.Xlf.parse', lambda: xlf.Xlf(xlf_path)),
+        ('RequiredFilesResponse.parse', lambda: xmds.RequiredFilesResponse().parse(rf_text)),
+        ('RequiredFilesResponse.regex', lambda: xmds._RESOURCE_ID.sub(r'\1\3', rf_text)),
+        ('ScheduleResponse.parse', lambda: xmds.ScheduleResponse().parse(sched_text)),
+        ('util.md5sum_match', lambda: util.md5sum_match(md5_path, md5sum)),
+        ('schedule.evaluate', lambda: evaluate_schedule(schedule, now)),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(old, new):
+    before = dict(((r['bench'], r['n']), r) for r in old['results'])
+    print '%-30s %8s %12s %12s %8s' % ('bench', 'n', old.get('commit') or 'before', new.get('commit') or 'after',
+                                       'ratio')
+    for r in new['results']:
+        o = before.get((r['bench'], r['n']))
+        if not o:
+            continue
+        print '%-30s %8d %12.6f %12.6f %7.2fx' % (r['bench'], r['n'], o['best'], r['best'], r['best'] / o['best'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="xiboside parsing microbenchmarks")
+    parser.add_argument('--sizes', default=','.join(str(n) for n in SIZES),
+                        help="comma separated element counts, default %(default)s")
+    parser.add_argument('--bench', default='', help="only run benchmarks whose name contains this")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds spent per measurement")
+    parser.add_argument('-o', '--output', help="write the JSON results to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='xiboside-bench-')
+    try:
+        for n in [int(x) for x in args.sizes.split(',') if x]:
+            for name, func in benchmarks(n, work_dir):
+                if args.bench not in name:
+                    continue
+                best, median = measure(func, args.min_time)
+                results.append({'bench': name, 'n': n, 'best': best, 'median': median, 'per_item': best / n})
+                sys.stderr.write('%-30s %8d %12.6fs\n' % (name, n, best))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    elif not args.output:
+        print text
+
+
+if __name__ == '__main__':
+    main()
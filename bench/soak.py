@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+""" Headless long run soak: cycle MainWindow.set_layout through synthetic layouts.
+
+Layouts mix image, video (bench/fake-mplayer) and text regions, some of them
+shared between layouts. Every few switches it samples the RSS, Python object
+count, live QObject and widget counts and open file descriptors, then fits the
+growth per switch after a warm up and fails when one exceeds its threshold.
+
+Qt4 has no offscreen platform, without a DISPLAY the run is re-executed under
+xvfb-run when it is available.
+
+    bench/soak.py --layouts 500 --switches 5000 --interval 50 -o soak.json
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, os.pardir))
+
+
+def ensure_display():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # Qt5 and later
+    if os.environ.get('DISPLAY') or os.environ.get('XIBOSIDE_SOAK_XVFB'):
+        return
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'xvfb-run'), os.X_OK):
+            os.environ['XIBOSIDE_SOAK_XVFB'] = '1'
+            os.execvp('xvfb-run', ['xvfb-run', '-a', sys.executable] + sys.argv)
+
+
+def make_content(save_dir, count, seed=0):
+    """ Write count layouts, their images, videos and resources to save_dir. """
+    from PySide.QtGui import QColor
+    from PySide.QtGui import QImage
+
+    rnd = random.Random(seed)
+    images = []
+    for i in range(8):
+        img = QImage(320, 180, QImage.Format_RGB32)
+        img.fill(QColor.fromHsv(i * 45, 200, 200).rgb())
+        images.append('soak-%d.png' % i)
+        img.save(os.path.join(save_dir, images[-1]))
+    videos = []
+    for i in range(2):
+        videos.append('soak-%d.mp4' % i)
+        with open(os.path.join(save_dir, videos[-1]), 'wb') as f:
+            f.write('\0' * 1024)
+
+    layout_ids = []
+    for n in range(count):
+        layout_id = 'soak-%d' % n
+        regions = []
+        # a logo region identical in every other layout, exercises region reuse
+        if n % 2:
+            regions.append(('logo', [('logo', 'image', images[0])]))
+        for r in range(1 + n % 4):
+            media = []
+            for m in range(1 + rnd.randint(0, 3)):
+                kind = rnd.choice(('image', 'image', 'video', 'text'))
+                uri = rnd.choice(images) if 'image' == kind else rnd.choice(videos)
+                media.append(('m%d_%d_%d' % (n, r, m), kind, uri))
+            regions.append(('r%d_%d' % (n, r), media))
+
+        xml = []
+        for index, (region_id, media) in enumerate(regions):
+            items = []
+            for media_id, kind, uri in media:
+                if 'text' == kind:
+                    # raw text is drawn by TextMediaView, the resource is what WebKit would show
+                    items.append('<media id="%s" type="text" duration="1" render="html"><options/>'
+                                 '<raw><text><![CDATA[<p>%s</p>]]></text></raw></media>' % (media_id, media_id))
+                    with open(os.path.join(save_dir, '%s_%s_%s.html' % (layout_id, region_id, media_id)), 'w') as f:
+                        f.write('<html><body>%s</body></html>' % media_id)
+                else:
+                    items.append('<media id="%s" type="%s" duration="1" render="native"><options><uri>%s</uri>'
+                                 '</options><raw/></media>' % (media_id, kind, uri))
+            xml.append('<region id="%s" width="320" height="180" top="%d" left="%d">'
+                       '<options><loop>1</loop></options>%s</region>'
+                       % (region_id, 180 * (index / 4), 320 * (index % 4), ''.join(items)))
+        with open(os.path.join(save_dir, layout_id + '.xml'), 'w') as f:
+            f.write('<layout width="1280" height="720" bgcolor="#000000">%s</layout>' % ''.join(xml))
+        layout_ids.append(layout_id)
+    return layout_ids
+
+
+def sample(window, app):
+    from PySide.QtCore import QObject
+    import util
+
+    gc.collect()
+    return {
+        'time': time.time(),
+        'rss': util.process_rss(),
+        'objects': len(gc.get_objects()),
+        'qobjects': len(window.findChildren(QObject)),
+        'widgets': len(app.allWidgets()),
+        'fds': len(os.listdir('/proc/self/fd')),
+    }
+
+
+def slope(xs, ys):
+    """ Least squares growth of ys per unit of xs. """
+    n = float(len(xs))
+    if n < 2:
+        return 0.0
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    var = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var if var else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="xiboside headless soak run")
+    parser.add_argument('--layouts', type=int, default=200, help="number of synthetic layouts")
+    parser.add_argument('--switches', type=int, default=2000, help="number of layout switches")
+    parser.add_argument('--interval', type=int, default=100, help="milliseconds between switches")
+    parser.add_argument('--sample-every', type=int, default=50, help="switches between samples")
+    parser.add_argument('--warmup', type=int, default=200, help="switches ignored for growth")
+    parser.add_argument('--max-rss', type=float, default=4096, help="bytes per switch")
+    parser.add_argument('--max-objects', type=float, default=1.0, help="python objects per switch")
+    parser.add_argument('--max-qobjects', type=float, default=0.05, help="QObjects per switch")
+    parser.add_argument('--max-widgets', type=float, default=0.05, help="widgets per switch")
+    parser.add_argument('--max-fds', type=float, default=0.01, help="file descriptors per switch")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    ensure_display()
+    os.environ.setdefault('FAKE_MPLAYER_LENGTH', '1')
+
+    from PySide.QtCore import QTimer
+    from PySide.QtGui import QApplication
+
+    import ui
+    import xibo
+    from fakecms import Content
+    from fakecms import FakeCms
+
+    app = QApplication(sys.argv)
+    work_dir = tempfile.mkdtemp(prefix='xiboside-soak-')
+    save_dir = os.path.join(work_dir, 'save')
+    os.mkdir(save_dir)
+    layout_ids = make_content(save_dir, args.layouts, args.seed)
+
+    # the xmds side only needs something to talk to, it never picks a layout here
+    cms = FakeCms(content=Content(files=0, resources=0))
+    cms.start()
+    config = xibo.XiboConfig(os.path.join(work_dir, 'config.json'))
+    config.url = cms.url
+    config.saveDir = save_dir
+    config.xmdsVersion = 4
+    config.mplayer = os.path.join(BENCH, 'fake-mplayer')
+    config.metricsPort = 0
+
+    samples = []
+    state = {'switches': 0}
+    try:
+        with ui.MainWindow(config) as window:
+            window._xmds.layout_signal.disconnect(window.set_layout)
+            window.setGeometry(0, 0, 1280, 720)
+            window.show()
+
+            def switch():
+                n = state['switches']
+                window.set_layout(layout_ids[n % len(layout_ids)], str(n + 1), (0, 0))
+                state['switches'] = n + 1
+                if state['switches'] % args.sample_every == 0:
+                    samples.append(dict(sample(window, app), switches=state['switches']))
+                if state['switches'] >= args.switches:
+                    app.quit()
+
+            timer = QTimer()
+            timer.timeout.connect(switch)
+            timer.start(args.interval)
+            app.exec_()
+            timer.stop()
+    finally:
+        cms.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    measured = [s for s in samples if s['switches'] > args.warmup]
+    xs = [s['switches'] for s in measured]
+    limits = {
+        'rss': args.max_rss, 'objects': args.max_objects, 'qobjects': args.max_qobjects,
+        'widgets': args.max_widgets, 'fds': args.max_fds,
+    }
+    growth = dict((k, slope(xs, [s[k] for s in measured])) for k in limits)
+    failures = sorted(k for k in limits if growth[k] > limits[k])
+    report = {
+        'params': vars(args),
+        'growth_per_switch': growth,
+        'limits': limits,
+        'failed': failures,
+        'samples': samples,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+    for k in sorted(limits):
+        print '%-10s %+14.4f per switch (limit %g)%s' % (k, growth[k], limits[k], ' FAIL' if k in failures else '')
+    if len(measured) < 2:
+        print 'Not enough samples after the warm up, raise --switches'
+        return 2
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
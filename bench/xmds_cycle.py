@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+""" End to end XMDS download/cycle benchmark.
+
+Drives a real, headless XmdsThread.__xmds_cycle (single shot, fresh saveDir
+each round) against bench/fakecms.py running in a separate process, so the
+cpu and memory figures belong to the player side only. Prints a JSON report:
+
+    bench/xmds_cycle.py --files 50 --size 2097152 --latency 0.05 --rounds 3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from fakecms import Content
+from fakecms import FakeCms
+
+
+def _serve(queue, args):
+    cms = FakeCms('127.0.0.1', 0, Content(args.files, args.size, args.resources),
+                  args.latency, args.bandwidth, args.failure_rate)
+    queue.put(cms.url)
+    cms.run()
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_cycle(url, work_dir):
+    import xibo
+    from xthread import XmdsThread
+
+    save_dir = os.path.join(work_dir, 'save')
+    config = xibo.XiboConfig(os.path.join(work_dir, 'config.json'))
+    config.url = url
+    config.saveDir = save_dir
+
+    downloaded = []
+    wall = time.time()
+    cpu = _cpu_time()
+    thread = XmdsThread(config, None)
+    thread.single_shot = True
+    thread.content_updated_signal.connect(downloaded.extend)
+    thread._XmdsThread__xmds_cycle()
+    wall = time.time() - wall
+    cpu = _cpu_time() - cpu
+
+    size = 0
+    for name in os.listdir(save_dir):
+        size += os.path.getsize(os.path.join(save_dir, name))
+    return {
+        'seconds': wall,
+        'cpu_seconds': cpu,
+        'files': len(downloaded),
+        'bytes': size,
+        'files_per_second': len(downloaded) / wall if wall else 0,
+        'mb_per_second': size / 1048576.0 / wall if wall else 0,
+        'cpu_seconds_per_mb': cpu / (size / 1048576.0) if size else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XMDS download/cycle benchmark")
+    parser.add_argument('--url', help="use a running CMS (or fakecms.py) instead of starting one")
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    parser.add_argument('--resources', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('-o', '--output', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    from PySide.QtCore import QCoreApplication
+    app = QCoreApplication(sys.argv)
+
+    server = None
+    url = args.url
+    if not url:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve, args=(queue, args))
+        server.daemon = True
+        server.start()
+        url = queue.get(timeout=30)
+
+    rounds = []
+    try:
+        for _ in range(args.rounds):
+            work_dir = tempfile.mkdtemp(prefix='xiboside-bench-')
+            try:
+                rounds.append(run_cycle(url, work_dir))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        if server:
+            server.terminate()
+
+    best = sorted(rounds, key=lambda r: r['seconds'])[len(rounds) / 2] if rounds else {}
+    report = {
+        'params': vars(args),
+        'median': best,
+        'rounds': rounds,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print text
+    del app
+
+
+if __name__ == '__main__':
+    main()
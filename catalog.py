@@ -0,0 +1,245 @@
+import json
+import logging
+import mimetypes
+import os
+import subprocess
+import threading
+
+log = logging.getLogger('xiboside.catalog')
+
+
+class MediaCatalog:
+    """ Metadata of the files in saveDir, probed once when they are downloaded.
+
+    Entries are keyed by file name and hold the size, mtime and md5 of the
+    probed file, plus duration, width, height and codec when they apply.
+    An entry whose file changed on disk is ignored until probed again.
+    Images larger than the regions showing them get a scaled down copy,
+    'derived', next to the original.
+    """
+    file_name = 'catalog.json'
+
+    def __init__(self, save_dir, mplayer='mplayer'):
+        self._save_dir = save_dir
+        self._path = os.path.join(save_dir, self.file_name)
+        self._mplayer = mplayer
+        self._lock = threading.Lock()
+        # the screens share the catalog, one of them at a time writes it
+        self._save_lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        with self._lock:
+            self._entries = entries if isinstance(entries, dict) else {}
+            self._dirty = False
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                data = json.dumps(self._entries, indent=1, sort_keys=True)
+                self._dirty = False
+            tmp = self._path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self._path)
+            except (IOError, OSError) as err:
+                log.error('Failed to save %s: %s' % (self._path, err))
+                with self._lock:
+                    self._dirty = True
+                return False
+        return True
+
+    def get(self, path):
+        name = os.path.basename(path)
+        with self._lock:
+            info = self._entries.get(name)
+        if info is None:
+            return None
+        try:
+            st = os.stat(os.path.join(self._save_dir, name))
+        except OSError:
+            return None
+        if st.st_size != info.get('size') or st.st_mtime != info.get('mtime'):
+            return None
+        return info
+
+    def find(self, md5sum):
+        """ Path of a file of saveDir with this md5, None unless its entry is still valid. """
+        with self._lock:
+            names = [name for name, info in self._entries.iteritems() if info.get('md5') == md5sum]
+        for name in names:
+            if self.get(name) is not None:
+                return os.path.join(self._save_dir, name)
+        return None
+
+    def has(self, path):
+        return self.get(path) is not None
+
+    def duration(self, path):
+        info = self.get(path)
+        return info.get('duration', 0) if info else 0
+
+    def probe(self, path, md5sum=''):
+        name = os.path.basename(path)
+        path = os.path.join(self._save_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        info = {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5sum}
+        kind = (mimetypes.guess_type(path)[0] or '').split('/')[0]
+        if 'image' == kind:
+            info.update(self._probe_image(path))
+        elif kind in ('video', 'audio'):
+            info.update(self._probe_video(path))
+
+        with self._lock:
+            self._entries[name] = info
+            self._dirty = True
+        return info
+
+    def derivative(self, path):
+        """ The display sized copy of an image if it is up to date, else path itself. """
+        info = self.get(path)
+        derived = info.get('derived') if info else None
+        if derived and derived.get('md5') == info.get('md5'):
+            derived_path = os.path.join(self._save_dir, derived['file'])
+            if os.path.isfile(derived_path):
+                return derived_path
+        return path
+
+    def derive(self, path, width, height):
+        """ Write a copy of an image scaled down to cover width x height, once per md5 and size. """
+        from PySide.QtCore import QSize
+        from PySide.QtCore import Qt
+        from PySide.QtGui import QImageReader
+
+        name = os.path.basename(path)
+        info = self.get(name)
+        if not info or not info.get('width') or not info.get('height'):
+            return False
+        # not tried again until the file changes, a new probe drops the mark
+        if 'derive_failed' in info and info['derive_failed'] == info.get('md5'):
+            return False
+        derived = info.get('derived')
+        if derived and derived.get('md5') == info.get('md5') and derived.get('target') == [width, height] \
+                and self.derivative(name) != name:
+            return False
+        size = QSize(info['width'], info['height']).scaled(width, height, Qt.KeepAspectRatioByExpanding)
+        if size.width() >= info['width'] or size.height() >= info['height']:
+            # the regions grew, a copy made for smaller ones would be scaled up
+            self._drop_derived(name, info)
+            return False
+
+        root, ext = os.path.splitext(name)
+        derived_name = '%s.derived%s' % (root, ext)
+        reader = QImageReader(os.path.join(self._save_dir, name))
+        # jpeg decodes straight at the smaller size
+        reader.setScaledSize(size)
+        image = reader.read()
+        tmp = os.path.join(self._save_dir, derived_name + '.tmp')
+        if image.isNull() or not image.save(tmp, str(reader.format()) or None, 90):
+            log.error('Failed to scale %s: %s' % (name, reader.errorString()))
+            with self._lock:
+                if self._entries.get(name) is info:
+                    info['derive_failed'] = info.get('md5')
+                    self._dirty = True
+            return False
+        os.rename(tmp, os.path.join(self._save_dir, derived_name))
+        with self._lock:
+            if self._entries.get(name) is info:
+                info['derived'] = {
+                    'file': derived_name, 'md5': info.get('md5'), 'target': [width, height],
+                    'width': size.width(), 'height': size.height()
+                }
+                self._dirty = True
+        return True
+
+    def _drop_derived(self, name, info):
+        with self._lock:
+            if self._entries.get(name) is not info or 'derived' not in info:
+                return
+            derived = info.pop('derived')
+            self._dirty = True
+        try:
+            os.remove(os.path.join(self._save_dir, derived['file']))
+        except OSError:
+            pass
+
+    def forget(self, path):
+        with self._lock:
+            if self._entries.pop(os.path.basename(path), None) is not None:
+                self._dirty = True
+
+    @staticmethod
+    def _probe_image(path):
+        # reads the header only, QImageReader is fine outside the gui thread.
+        from PySide.QtGui import QImageReader
+        reader = QImageReader(path)
+        size = reader.size()
+        if not size.isValid():
+            return {}
+        return {
+            'width': size.width(),
+            'height': size.height(),
+            'codec': str(reader.format())
+        }
+
+    def _probe_video(self, path):
+        args = [
+            self._mplayer, '-identify', '-frames', '0', '-vo', 'null', '-ao', 'null',
+            '-noconfig', 'all', '-nolirc', path
+        ]
+        try:
+            with open(os.devnull, 'w') as devnull:
+                out = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+        except OSError as err:
+            log.error('Failed to probe %s: %s' % (path, err))
+            return {}
+
+        ids = {}
+        for line in out.splitlines():
+            if line.startswith('ID_') and '=' in line:
+                key, val = line.split('=', 1)
+                ids[key] = val.strip()
+
+        info = {}
+        try:
+            if 'ID_LENGTH' in ids:
+                info['duration'] = float(ids['ID_LENGTH'])
+            if 'ID_VIDEO_WIDTH' in ids:
+                info['width'] = int(ids['ID_VIDEO_WIDTH'])
+            if 'ID_VIDEO_HEIGHT' in ids:
+                info['height'] = int(ids['ID_VIDEO_HEIGHT'])
+        except ValueError:
+            pass
+        codec = ids.get('ID_VIDEO_CODEC') or ids.get('ID_VIDEO_FORMAT')
+        if codec:
+            info['codec'] = codec
+        return info
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def media_catalog(save_dir, mplayer='mplayer'):
+    """ The catalog of a saveDir, one instance per directory and process. """
+    save_dir = os.path.abspath(save_dir)
+    with _catalogs_lock:
+        if save_dir not in _catalogs:
+            _catalogs[save_dir] = MediaCatalog(save_dir, mplayer)
+        return _catalogs[save_dir]
@@ -0,0 +1,177 @@
+import logging
+import os
+from collections import OrderedDict
+
+from PySide.QtCore import QObject
+from PySide.QtCore import QRunnable
+from PySide.QtCore import QThreadPool
+from PySide.QtCore import Qt
+from PySide.QtCore import Signal
+from PySide.QtCore import Slot
+from PySide.QtGui import QImage
+from PySide.QtGui import QPixmap
+
+log = logging.getLogger('xiboside.imgcache')
+
+
+class ImageCache:
+    """ Process wide LRU cache of decoded and scaled QPixmap.
+
+    Entries are keyed by (path, mtime, width, height) so a re-downloaded
+    file never serves a stale pixmap. The memory budget is in bytes.
+    """
+    def __init__(self, budget=128 * 1024 * 1024):
+        self._budget = budget
+        self._used = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path, width, height):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        return path, mtime, int(width), int(height)
+
+    @staticmethod
+    def cost(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) / 8
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def used(self):
+        return self._used
+
+    def set_budget(self, budget):
+        self._budget = max(0, int(budget))
+        self._evict()
+
+    def get(self, path, width, height):
+        key = self.key(path, width, height)
+        entry = self._entries.pop(key, None) if key else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # re-insert as the most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, path, width, height, pixmap):
+        key = self.key(path, width, height)
+        if key is None or pixmap is None or pixmap.isNull():
+            return False
+
+        cost = self.cost(pixmap)
+        if cost > self._budget:
+            return False
+
+        # drop older versions of the same file at the same size
+        for old in [k for k in self._entries if k[0] == path and k[2:] == key[2:]]:
+            self._used -= self._entries.pop(old)[1]
+
+        self._entries[key] = (pixmap, cost)
+        self._used += cost
+        self._evict()
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self._used = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'used': self._used,
+            'budget': self._budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _evict(self):
+        while self._entries and self._used > self._budget:
+            key, entry = self._entries.popitem(last=False)
+            self._used -= entry[1]
+            self.evictions += 1
+            log.debug('evicted %s (%dx%d)' % (key[0], key[2], key[3]))
+
+
+class _DecodeJob(QRunnable):
+    def __init__(self, loader, path, width, height, source):
+        super(_DecodeJob, self).__init__()
+        self._loader = loader
+        self._path = path
+        self._source = source
+        self._width = width
+        self._height = height
+
+    def run(self):
+        # QImage is safe outside the GUI thread, QPixmap is not.
+        img = QImage(self._source)
+        if not img.isNull():
+            img = img.scaled(self._width, self._height,
+                             Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        self._loader.decoded_signal.emit(self._path, self._width, self._height, img)
+
+
+class ImageLoader(QObject):
+    """ Decode and scale images in a thread pool, deliver QPixmap on the GUI thread. """
+    decoded_signal = Signal(str, int, int, object)
+    ready_signal = Signal(str, int, int, object)
+
+    def __init__(self, cache, threads=2):
+        super(ImageLoader, self).__init__()
+        self._cache = cache
+        self._pending = set()
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(threads)
+        self.decoded_signal.connect(self._decoded)
+
+    def set_threads(self, threads):
+        self._pool.setMaxThreadCount(max(1, int(threads)))
+
+    def request(self, path, width, height, source=None):
+        """ Return the cached pixmap, or None and schedule a decode.
+
+        Entries are keyed by path, the file is read from source when given.
+        """
+        width, height = int(width), int(height)
+        pixmap = self._cache.get(path, width, height)
+        if pixmap is not None:
+            return pixmap
+
+        key = (path, width, height)
+        if key not in self._pending:
+            self._pending.add(key)
+            self._pool.start(_DecodeJob(self, path, width, height, source or path))
+        return None
+
+    @Slot(str, int, int, object)
+    def _decoded(self, path, width, height, img):
+        self._pending.discard((path, width, height))
+        if img.isNull():
+            log.error('Failed to decode %s' % path)
+            return
+
+        pixmap = QPixmap.fromImage(img)
+        self._cache.put(path, width, height, pixmap)
+        self.ready_signal.emit(path, width, height, pixmap)
+
+
+image_cache = ImageCache()
+_image_loader = None
+
+
+def image_loader():
+    global _image_loader
+    if _image_loader is None:
+        _image_loader = ImageLoader(image_cache)
+    return _image_loader
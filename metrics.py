@@ -0,0 +1,185 @@
+import BaseHTTPServer
+import json
+import logging
+import threading
+import time
+
+import util
+
+log = logging.getLogger('xiboside.metrics')
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES = tuple(2 ** n * 1024 * 1024 for n in range(4, 13))
+RATIO = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 2, 4)
+
+
+class Histogram:
+    def __init__(self, buckets=SECONDS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield bound, total
+
+
+class Metrics:
+    """ Histograms keyed by name and labels, shared by the whole player. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def to_dict(self):
+        data = {}
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                data.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': h.count,
+                    'sum': h.sum,
+                    'buckets': [[b if b != float('inf') else '+Inf', n] for b, n in h.cumulative()]
+                })
+        return data
+
+    def render(self):
+        """ Prometheus text exposition format. """
+        lines = []
+        last = None
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                if name != last:
+                    if name in self._help:
+                        lines.append('# HELP %s %s' % (name, self._help[name]))
+                    lines.append('# TYPE %s histogram' % name)
+                    last = name
+                label = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                for bound, n in h.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s} %d' % (name, ','.join(filter(None, [label, 'le="%s"' % le])), n))
+                suffix = '{%s}' % label if label else ''
+                lines.append('%s_sum%s %r' % (name, suffix, h.sum))
+                lines.append('%s_count%s %d' % (name, suffix, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('xibo_media_gap_seconds', 'Time between an item finishing and the next one starting in a region')
+metrics.describe('xibo_media_first_frame_seconds', 'Time from play request to the item being on screen')
+metrics.describe('xibo_layout_lateness_seconds', 'Delay of a scheduled layout switch after its fromdt')
+metrics.describe('xibo_layout_switch_seconds', 'Time spent in the gui thread switching layouts')
+metrics.describe('xibo_process_rss_bytes', 'Sampled resident memory of the player and its mplayer processes')
+metrics.describe('xibo_process_cpu_ratio', 'Sampled cpu usage, 1.0 is one core')
+metrics.describe('xibo_image_decode_miss_seconds', 'Play time of images whose decode did not arrive before it ran out')
+metrics.describe('xibo_video_start_miss_seconds', 'Time videos waited for mplayer before they were given up')
+metrics.describe('xibo_first_pixel_seconds', 'Time from process start to the first item on screen')
+
+_first_pixel_seen = False
+
+
+def first_pixel(registry=metrics, target=1.0):
+    """ Record the time to first pixel, only the first call of the process counts. """
+    global _first_pixel_seen
+    if _first_pixel_seen:
+        return
+    _first_pixel_seen = True
+    started = util.process_start_time()
+    if not started:
+        return
+    seconds = time.time() - started
+    registry.observe('xibo_first_pixel_seconds', seconds)
+    if seconds > target:
+        log.warning('First pixel after %.2fs, target is %.2fs' % (seconds, target))
+    else:
+        log.info('First pixel after %.2fs' % seconds)
+
+
+class ProcessSampler:
+    """ Feed rss and cpu usage of a set of processes into the histograms. """
+    def __init__(self, registry=metrics):
+        self._registry = registry
+        self._last = {}
+
+    def sample(self, processes):
+        """ processes: [(name, pid), ...], a name may be shared by several processes. """
+        now = time.time()
+        seen = {}
+        for name, pid in processes:
+            cpu = util.process_cpu_time(pid)
+            rss = util.process_rss(pid)
+            if not rss:
+                continue
+            self._registry.observe('xibo_process_rss_bytes', rss, BYTES, process=name)
+            last = self._last.get((name, pid))
+            if last and now > last[0]:
+                self._registry.observe('xibo_process_cpu_ratio', (cpu - last[1]) / (now - last[0]), RATIO,
+                                       process=name)
+            seen[(name, pid)] = (now, cpu)
+        self._last = seen
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            body = json.dumps(metrics.to_dict(), indent=1, sort_keys=True)
+            content_type = 'application/json'
+        elif self.path.startswith('/metrics'):
+            body = metrics.render()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+
+class MetricsServer(threading.Thread):
+    """ Serve /metrics (Prometheus text) and /metrics.json on a local port. """
+    def __init__(self, host, port):
+        super(MetricsServer, self).__init__(name='metrics')
+        self.daemon = True
+        self._server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
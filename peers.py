@@ -0,0 +1,178 @@
+import BaseHTTPServer
+import SocketServer
+import logging
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+import urllib2
+
+import util
+from catalog import media_catalog
+
+log = logging.getLogger('xiboside.peers')
+
+ANNOUNCE = 'xiboside-peer'
+
+
+class Peers(object):
+    """ Other players of the LAN that may have a media file before the CMS is asked.
+
+    Peers are the static ones of the configuration plus the ones heard by
+    PeerDiscovery recently. A file fetched from a peer is kept only when its
+    md5 matches the one the CMS asked for.
+    """
+    def __init__(self, timeout=5, expire=60):
+        self._lock = threading.Lock()
+        self._static = []
+        self._seen = {}
+        self._timeout = timeout
+        self._expire = expire
+        self.hits = 0
+        self.misses = 0
+
+    def set_static(self, addresses):
+        """ addresses: ['host:port', ...] """
+        with self._lock:
+            self._static = [a for a in addresses if a]
+
+    def seen(self, address):
+        with self._lock:
+            self._seen[address] = time.time()
+
+    def addresses(self):
+        now = time.time()
+        with self._lock:
+            seen = [a for a, t in self._seen.iteritems() if now - t < self._expire and a not in self._static]
+            return self._static + sorted(seen)
+
+    def fetch(self, md5sum, path):
+        """ Download the file of md5sum to path from the first peer that has it. """
+        addresses = self.addresses()
+        if not md5sum or not addresses:
+            return False
+        tmp = path + '.peer'
+        for address in addresses:
+            url = 'http://%s/media/%s' % (address, md5sum)
+            try:
+                resp = urllib2.urlopen(url, timeout=self._timeout)
+                try:
+                    with open(tmp, 'wb') as f:
+                        shutil.copyfileobj(resp, f, 1024 * 1024)
+                        f.flush()
+                        os.fsync(f.fileno())
+                finally:
+                    resp.close()
+            except (IOError, OSError, socket.error), err:
+                log.debug('%s: %s' % (url, err))
+                continue
+            if util.md5sum_match(tmp, md5sum):
+                os.rename(tmp, path)
+                self.hits += 1
+                log.info('%s fetched from peer %s' % (os.path.basename(path), address))
+                return True
+            log.warning('%s from peer %s does not match its md5' % (os.path.basename(path), address))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        self.misses += 1
+        return False
+
+
+peers = Peers()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        path = None
+        if 2 == len(parts) and 'media' == parts[0]:
+            path = self.server.catalog.find(parts[1])
+        if not path:
+            self.send_error(404)
+            return
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class PeerServer(threading.Thread):
+    """ Serve the media of saveDir that the catalog knows as verified, by md5. """
+    def __init__(self, host, port, save_dir):
+        super(PeerServer, self).__init__(name='peers')
+        self.daemon = True
+        self._server = _Server((host, port), _Handler)
+        self._server.catalog = media_catalog(save_dir)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class PeerDiscovery(threading.Thread):
+    """ Announce the PeerServer port by UDP broadcast and listen to the other players doing so. """
+    def __init__(self, port, serve_port, interval=10, registry=peers):
+        super(PeerDiscovery, self).__init__(name='peer-discovery')
+        self.daemon = True
+        self._port = port
+        self._serve_port = serve_port
+        self._interval = interval
+        self._registry = registry
+        self._id = '%08x' % random.getrandbits(32)
+        self._stop = threading.Event()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(('', port))
+        self._sock.settimeout(1)
+
+    def run(self):
+        next_announce = 0
+        while not self._stop.is_set():
+            if time.time() >= next_announce:
+                try:
+                    self._sock.sendto('%s %s %d' % (ANNOUNCE, self._id, self._serve_port),
+                                      ('<broadcast>', self._port))
+                except socket.error, err:
+                    log.debug('announce failed: %s' % err)
+                next_announce = time.time() + self._interval
+            try:
+                data, (host, _) = self._sock.recvfrom(256)
+            except socket.timeout:
+                continue
+            except socket.error, err:
+                log.debug('discovery failed: %s' % err)
+                continue
+            fields = data.split()
+            if 3 == len(fields) and ANNOUNCE == fields[0] and self._id != fields[1] and fields[2].isdigit():
+                self._registry.seen('%s:%s' % (host, fields[2]))
+
+    def stop(self):
+        self._stop.set()
+        self.join(2)
+        self._sock.close()
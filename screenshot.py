@@ -0,0 +1,90 @@
+import logging
+
+from PySide.QtCore import QBuffer
+from PySide.QtCore import QByteArray
+from PySide.QtCore import QIODevice
+from PySide.QtCore import QObject
+from PySide.QtCore import QRunnable
+from PySide.QtCore import QThreadPool
+from PySide.QtCore import Qt
+from PySide.QtCore import Signal
+from PySide.QtCore import Slot
+from PySide.QtGui import QPixmap
+
+log = logging.getLogger('xiboside.screenshot')
+
+
+def encode_jpeg(image, width, quality, max_bytes=0):
+    """ JPEG bytes of image scaled down to width, the quality is lowered until they fit in max_bytes. """
+    if image.width() > width > 0:
+        image = image.scaledToWidth(width, Qt.SmoothTransformation)
+    while True:
+        data = QByteArray()
+        buf = QBuffer(data)
+        buf.open(QIODevice.WriteOnly)
+        image.save(buf, 'JPEG', quality)
+        buf.close()
+        if max_bytes <= 0 or data.size() <= max_bytes or quality <= 10:
+            return str(data)
+        quality -= 10
+
+
+class _ScreenShotJob(QRunnable):
+    def __init__(self, shooter, image):
+        super(_ScreenShotJob, self).__init__()
+        self._shooter = shooter
+        self._image = image
+
+    def run(self):
+        # QImage is safe outside the GUI thread, the upload blocks this pool thread only.
+        ok = False
+        try:
+            data = encode_jpeg(self._image, self._shooter.width, self._shooter.quality, self._shooter.max_bytes)
+            ok = self._shooter.upload(data)
+        except Exception as err:
+            log.error('Screenshot failed: %s' % err)
+        self._shooter.done_signal.emit(bool(ok))
+
+
+class ScreenShooter(QObject):
+    """ Grab a window on request, scale, encode and upload it in a worker thread.
+
+    The GUI thread only reads the window back, a request while the previous
+    screenshot is still on its way is dropped.
+    """
+    done_signal = Signal(bool)
+
+    def __init__(self, window, upload, width=640, quality=60, max_bytes=0):
+        super(ScreenShooter, self).__init__(window)
+        self._window = window
+        self.upload = upload
+        self.width = width
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self._busy = False
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self.done_signal.connect(self._done)
+        self.taken = 0
+
+    @Slot()
+    def take(self):
+        if self._busy or not self._window.isVisible():
+            return False
+        # from the X server, the native video and web windows are in it too
+        image = QPixmap.grabWindow(self._window.winId()).toImage()
+        if image.isNull():
+            return False
+        self._busy = True
+        self._pool.start(_ScreenShotJob(self, image))
+        return True
+
+    @Slot(bool)
+    def _done(self, ok):
+        self._busy = False
+        if ok:
+            self.taken += 1
+            log.info('Screenshot submitted')
+
+    def dispose(self):
+        self._pool.waitForDone(2000)
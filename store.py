@@ -0,0 +1,166 @@
+import Queue
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
+log = logging.getLogger('xiboside.store')
+
+
+class HotStore:
+    """ Size capped copies, in a RAM backed directory, of the files of saveDir about to be played.
+
+    saveDir stays the persistent cold tier. The files of the current and next
+    layouts are copied to the hot directory by a background thread, least
+    recently promoted files that no layout wants any more are dropped first.
+    resolve() gives the hot copy of a file while it matches the original.
+    Players sharing the hot directory each use a subdirectory named after
+    their saveDir, and only ever delete the files in it.
+    """
+    def __init__(self):
+        self._dir = None
+        self._budget = 0
+        self._used = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._wanted = {}
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._dir is not None
+
+    def setup(self, hot_dir, budget, save_dir):
+        if self._dir is not None or not hot_dir or budget <= 0:
+            return
+        hot_dir = os.path.join(hot_dir, md5(os.path.abspath(save_dir)).hexdigest()[:12])
+        try:
+            if not os.path.isdir(hot_dir):
+                os.makedirs(hot_dir, 0o700)
+            # copies of a previous run of this player may be stale, start clean
+            self._clear(hot_dir)
+        except OSError as err:
+            log.error('Hot store disabled, %s' % err)
+            return
+        self._dir = hot_dir
+        self._budget = budget
+        self._thread = threading.Thread(target=self._run, name='hot-store')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def dispose(self):
+        if self._dir is None:
+            return
+        self._queue.put(None)
+        self._thread.join(2)
+        with self._lock:
+            self._files.clear()
+            self._used = 0
+        try:
+            self._clear(self._dir)
+            os.rmdir(self._dir)
+        except OSError:
+            pass
+        self._dir = None
+
+    @staticmethod
+    def _clear(hot_dir):
+        for name in os.listdir(hot_dir):
+            path = os.path.join(hot_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def resolve(self, path):
+        if self._dir is None:
+            return path
+        name = os.path.basename(path)
+        with self._lock:
+            stamp = self._files.get(name)
+        if stamp is None or not stamp[2]:
+            return path
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path
+        if (st.st_size, st.st_mtime) != stamp[:2]:
+            return path
+        return os.path.join(self._dir, name)
+
+    def promote(self, key, paths):
+        """ The files wanted under key (a layout slot such as the current or the next one). """
+        if self._dir is None:
+            return
+        with self._lock:
+            self._wanted[key] = list(paths)
+        self._queue.put(key)
+
+    def _run(self):
+        while True:
+            if self._queue.get() is None:
+                return
+            with self._lock:
+                wanted = []
+                for paths in self._wanted.values():
+                    wanted.extend(p for p in paths if p not in wanted)
+            # small files first, they are the random reads
+            sizes = []
+            for path in wanted:
+                try:
+                    sizes.append((os.path.getsize(path), path))
+                except OSError:
+                    pass
+            names = set(os.path.basename(p) for p in wanted)
+            for size, path in sorted(sizes):
+                self._copy(path, size, names)
+
+    def _copy(self, path, size, names):
+        name = os.path.basename(path)
+        hot_path = os.path.join(self._dir, name)
+        if self.resolve(path) == hot_path:
+            with self._lock:
+                self._files[name] = self._files.pop(name)
+            return
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return
+        if size > self._budget:
+            return
+        with self._lock:
+            old = self._files.pop(name, None)
+            if old is not None:
+                self._used -= old[0]
+            for victim in [n for n in self._files if n not in names]:
+                if self._used + size <= self._budget:
+                    break
+                self._remove(victim)
+            if self._used + size > self._budget:
+                return
+            self._used += size
+            # (size, mtime) of the original when copied, and whether the copy is complete
+            self._files[name] = (size, mtime, False)
+        try:
+            shutil.copyfile(path, hot_path + '.tmp')
+            os.rename(hot_path + '.tmp', hot_path)
+        except (IOError, OSError) as err:
+            log.error('Failed to promote %s: %s' % (name, err))
+            with self._lock:
+                if self._files.pop(name, None) is not None:
+                    self._used -= size
+            return
+        with self._lock:
+            if name in self._files:
+                self._files[name] = (size, mtime, True)
+
+    def _remove(self, name):
+        self._used -= self._files.pop(name)[0]
+        try:
+            os.remove(os.path.join(self._dir, name))
+        except OSError:
+            pass
+
+
+hot_store = HotStore()
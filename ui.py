@@ -1,30 +1,72 @@
+import logging
+import os
 import time
 
 from PySide.QtCore import QThread
 from PySide.QtCore import QTimer
+from PySide.QtCore import Qt
+from PySide.QtGui import QFrame
+from PySide.QtGui import QGraphicsScene
+from PySide.QtGui import QGraphicsView
 from PySide.QtGui import QMainWindow
-from PySide.QtGui import QWidget
 
+import util
 import xlf
+from metrics import MetricsServer
+from metrics import ProcessSampler
+from metrics import metrics
+from peers import PeerDiscovery
+from peers import PeerServer
+from peers import peers
+from screenshot import ScreenShooter
+from store import hot_store
+from imgcache import image_cache
+from imgcache import image_loader
+from webengine import web_engine
+from webrender import web_renderers
 from xlfview import RegionView
+from xlfview import TextMediaView
+from xlfview import VideoPlayer
+from xlfview import reaper
 from xthread import XmdsThread
 from xthread import XmrThread
 
 
-class CentralWidget(QWidget):
+class CentralWidget(QGraphicsView):
+    """ One scene for the images and web pages of all regions, stacked by z-index.
+
+    Only videos get a native window, mplayer needs one to draw into.
+    """
     def __init__(self, xmds, parent):
         super(CentralWidget, self).__init__(parent)
         self._xmds = xmds
+        self.setScene(QGraphicsScene(self))
+        self.setFrameShape(QFrame.NoFrame)
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setInteractive(False)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setOptimizationFlags(QGraphicsView.DontSavePainterState | QGraphicsView.DontAdjustForAntialiasing)
+
+    def resizeEvent(self, event):
+        # scene coordinates are the layout's pixel coordinates
+        self.scene().setSceneRect(0, 0, event.size().width(), event.size().height())
+        super(CentralWidget, self).resizeEvent(event)
 
     def queue_stats(self, type_, from_date, to_date, schedule_id, layout_id, media_id):
         self._xmds.queue_stats(type_, from_date, to_date, schedule_id, layout_id, media_id)
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, config):
+    log = logging.getLogger('xiboside.MainWindow')
+
+    def __init__(self, config, screen=0):
         super(MainWindow, self).__init__()
         self._schedule_id = '0'
         self._config = config
+        self._screen = screen
         self._region_view = []
         self._xmds = None
         self._xmr = None
@@ -32,19 +74,68 @@ class MainWindow(QMainWindow):
 
         self._layout_id = None
         self._layout_time = (0, 0)
+        image_cache.set_budget(config.imageCacheSize * 1024 * 1024)
+        image_loader().set_threads(config.imageDecodeThreads)
+        web_engine.setup(config)
+        web_renderers().setup(config)
+        hot_store.setup(config.hotDir, config.hotDirSize * 1024 * 1024, config.saveDir)
+        VideoPlayer.command = config.mplayer
+        TextMediaView.enabled = config.nativeText
         self.setup_xmr()
         self.setup_xmds()
         self._central_widget = CentralWidget(self._xmds, self)
         self._layout_timer = QTimer()
         self._layout_timer.setSingleShot(True)
-        self._layout_timer.timeout.connect(self.stop)
+        self._layout_timer.timeout.connect(self.layout_expired)
+        self._next_layout = None
+        self._prebuilt = None
+        self._prebuild_timer = QTimer(self)
+        self._prebuild_timer.setSingleShot(True)
+        self._prebuild_timer.timeout.connect(self.prebuild)
+        self._start_timer = QTimer(self)
+        self._start_timer.setSingleShot(True)
+        self._start_timer.timeout.connect(self.start_next)
+        # change sets of several screens or cycles in a row make one refresh
+        self._updated_layouts = set()
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(500)
+        self._refresh_timer.timeout.connect(self.refresh_layout)
+        self._refresh_retries = 0
         self.setCentralWidget(self._central_widget)
+        self._metrics_server = None
+        self._sampler = ProcessSampler()
+        self._sample_timer = QTimer(self)
+        self._sample_timer.timeout.connect(self.sample_processes)
+        self.setup_metrics()
+        self._peer_server = None
+        self._peer_discovery = None
+        self.setup_peers()
+        self._screenshots = None
+        self._screenshot_timer = QTimer(self)
+        self.setup_screenshots()
+        # offline first, the cms only has to answer to change what is played
+        QTimer.singleShot(0, self.play_cached)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._prebuild_timer.stop()
+        self._start_timer.stop()
+        self.discard_prebuilt()
         self.stop()
+        web_renderers().dispose()
+        hot_store.dispose()
+        reaper().flush()
+        self._screenshot_timer.stop()
+        self._screenshots.dispose()
+        if self._metrics_server:
+            self._metrics_server.stop()
+        if self._peer_discovery:
+            self._peer_discovery.stop()
+        if self._peer_server:
+            self._peer_server.stop()
         self._xmds.stop()
         if self._xmr:
             self._xmr.stop()
@@ -52,22 +143,86 @@ class MainWindow(QMainWindow):
             pass
 
     def setup_xmds(self):
-        self._xmds = XmdsThread(self._config, self)
+        self._xmds = XmdsThread(self._config, self, self._screen)
         self._xmds.layout_signal.connect(self.set_layout)
-        self._xmds.downloaded_signal.connect(self.item_downloaded)
+        self._xmds.next_layout_signal.connect(self.prepare_layout)
+        self._xmds.content_updated_signal.connect(self.content_updated)
         if self._config.xmdsVersion > 4:
-            self._xmds.set_xmr_info(self._xmr.channel, self._xmr.pubkey)
+            self._xmds.set_xmr(self._xmr)
         self._xmds.start(QThread.IdlePriority)
 
+    def setup_metrics(self):
+        # the metrics are process wide, the first screen serves them
+        if self._config.metricsPort and not self._screen:
+            try:
+                self._metrics_server = MetricsServer(self._config.metricsHost, self._config.metricsPort)
+                self._metrics_server.start()
+            except IOError, err:
+                self.log.error('Metrics server not started: %s' % err)
+        if self._config.metricsSampleInterval > 0:
+            self._sample_timer.start(int(self._config.metricsSampleInterval * 1000))
+
+    def setup_peers(self):
+        # one server per process, the screens share saveDir
+        if self._screen:
+            return
+        peers.set_static(self._config.peers)
+        if not self._config.peerPort:
+            return
+        try:
+            self._peer_server = PeerServer('', self._config.peerPort, self._config.saveDir)
+            self._peer_server.start()
+            if self._config.peerDiscovery:
+                self._peer_discovery = PeerDiscovery(self._config.peerPort, self._peer_server.port)
+                self._peer_discovery.start()
+        except (IOError, OSError), err:
+            self.log.error('Peer cache not started: %s' % err)
+
+    def setup_screenshots(self):
+        self._screenshots = ScreenShooter(
+            self, self._xmds.submit_screenshot, self._config.screenshotWidth,
+            self._config.screenshotQuality, self._config.screenshotMaxSize * 1024
+        )
+        if self._xmr:
+            self._xmr.screenshot_signal.connect(self._screenshots.take)
+        self._screenshot_timer.timeout.connect(self._screenshots.take)
+        if self._config.screenshotInterval > 0:
+            self._screenshot_timer.start(int(self._config.screenshotInterval * 1000))
+
+    def sample_processes(self):
+        # WebKit runs inside the player process unless webRenderers is set, mplayer does not.
+        processes = [] if self._screen else [('xiboside', os.getpid())]
+        if not self._screen:
+            processes.extend(('webrender', pid) for pid in web_renderers().pids())
+        for view in self._region_view:
+            pid = view.player_pid()
+            if pid:
+                processes.append(('mplayer', pid))
+        self._sampler.sample(processes)
+
     def setup_xmr(self):
         if self._config.xmdsVersion > 4:
-            self._xmr = XmrThread(self._config, self)
+            self._xmr = XmrThread(self._config, self, self._screen)
             self._xmr.start(QThread.IdlePriority)
 
+    def play_cached(self):
+        """ Play what the last saved schedule says, before xmds is even reached. """
+        if self._layout_id is not None:
+            return
+        cached = self._xmds.cached_layout()
+        if cached:
+            self.log.info('Starting layout %s from the cached schedule' % cached[0])
+            self.set_layout(*cached)
+
     def set_layout(self, layout_id, schedule_id, layout_time):
         if self._layout_id != layout_id:
-            self.stop()
-            self.play(layout_id, schedule_id)
+            started = time.time()
+            if self.play(layout_id, schedule_id):
+                metrics.observe('xibo_layout_switch_seconds', time.time() - started)
+                if self._layout_id is not None and schedule_id and layout_time[0]:
+                    metrics.observe('xibo_layout_lateness_seconds', max(0, started - layout_time[0]))
+            else:
+                self.stop()
 
         self._layout_id = layout_id
         self._schedule_id = schedule_id
@@ -78,34 +233,194 @@ class MainWindow(QMainWindow):
             self._layout_timer.setInterval(int(stop_time * 1000))
             self._layout_timer.start()
 
-    def item_downloaded(self, entry):
-        if 'layout' == entry.type and self._layout_id == entry.id:
+    def prepare_layout(self, layout_id, schedule_id, layout_time):
+        """ Have the next scheduled layout built hidden prebuildSeconds before it starts. """
+        delay = layout_time[0] - self._config.prebuildSeconds - time.time()
+        # far ahead, a later xmds cycle will tell again
+        if not self._config.prebuildSeconds or delay > 24 * 3600:
+            return
+        if self._next_layout == (layout_id, schedule_id, layout_time):
+            return
+        self._next_layout = (layout_id, schedule_id, layout_time)
+        self.discard_prebuilt()
+        self._prebuild_timer.start(max(0, int(delay * 1000)))
+        self._start_timer.start(max(0, int((layout_time[0] - time.time()) * 1000)))
+
+    def start_next(self):
+        """ Switch to the next scheduled layout at its start, onto the regions pre-built for it. """
+        if not self._next_layout:
+            return
+        next_layout, self._next_layout = self._next_layout, None
+        self._start_timer.stop()
+        self.set_layout(*next_layout)
+
+    def layout_expired(self):
+        # back to back layouts, the next one starts where this one ends
+        if self._next_layout and self._next_layout[2][0] <= time.time() + 1:
+            self.start_next()
+        else:
             self.stop()
-            self.play(self._layout_id, self._schedule_id)
 
-    def play(self, layout_id, schedule_id):
+    def prebuild(self):
+        if not self._next_layout or self._next_layout[0] == self._layout_id:
+            return
+        layout_id, schedule_id, layout_time = self._next_layout
+        available = util.mem_available()
+        if available and available < self._config.prebuildMinFree * 1024 * 1024:
+            self.log.warning('Not pre-building layout %s, only %d MiB available' % (layout_id, available >> 20))
+            return
+        path = "%s/%s%s" % (self._config.saveDir, layout_id, self._config.layout_file_ext)
+        layout = xlf.layout_cache.get(path)
+        if not layout:
+            return
+        self.promote(layout, layout_id, 'next')
+
+        # regions shared with the playing layout carry over, they need no warm up
+        running = set(view.signature for view in self._region_view)
+        views = []
+        for region in layout.regions:
+            if RegionView.signature_of(region, layout_id) in running:
+                continue
+            view = RegionView(region, layout_id, schedule_id, self._config.saveDir, self._central_widget)
+            view.prepare()
+            views.append(view)
+        self._prebuilt = (layout_id, views)
+        self.log.info('Layout %s pre-built, %d regions' % (layout_id, len(views)))
+
+    def promote(self, layout, layout_id, slot):
+        """ Have the files of a layout copied to the RAM backed hot store. """
+        files = []
+        for region in layout.regions:
+            files.extend(RegionView.files_of(region, layout_id, self._config.saveDir))
+        hot_store.promote((self._screen, slot), files)
+
+    def discard_prebuilt(self):
+        if self._prebuilt:
+            for view in self._prebuilt[1]:
+                view.stop()
+        self._prebuilt = None
+
+    def _take_prebuilt(self, layout_id):
+        prebuilt = {}
+        if self._prebuilt and self._prebuilt[0] == layout_id:
+            for view in self._prebuilt[1]:
+                prebuilt.setdefault(view.signature, []).append(view)
+            self._prebuilt = None
+        else:
+            self.discard_prebuilt()
+        return prebuilt
+
+    def content_updated(self, entries):
+        # A re-downloaded media file is picked up by its views at their next play,
+        # they check the file's mtime (see ImageCache and VideoPlayer.load).
+        self._updated_layouts.update(entry.id for entry in entries if 'layout' == entry.type)
+        if self._updated_layouts:
+            self._refresh_retries = 0
+            self._refresh_timer.start(500)
+
+    def refresh_layout(self):
+        """ Patch the playing layout if it changed, once all the files it reads are there. """
+        if self._layout_id not in self._updated_layouts:
+            self._updated_layouts.clear()
+            return
+        path = "%s/%s%s" % (self._config.saveDir, self._layout_id, self._config.layout_file_ext)
+        layout = xlf.layout_cache.get(path)
+        if not layout:
+            self._retry_refresh()
+            return
+        # an old copy of a file that failed to download again is not good enough
+        stale = self._xmds.stale_files()
+        for region in layout.regions:
+            for file_path in RegionView.files_of(region, self._layout_id, self._config.saveDir, derived=False):
+                if file_path in stale or not os.path.isfile(file_path):
+                    self.log.info('Layout %s not refreshed yet, %s is missing' % (self._layout_id, file_path))
+                    self._retry_refresh()
+                    return
+        self._updated_layouts.clear()
+        self._refresh_retries = 0
+        self.play(self._layout_id, self._schedule_id, patch=True)
+
+    def _retry_refresh(self):
+        # the downloads may be done, a change set may never come again
+        self._refresh_retries += 1
+        self._refresh_timer.start(min(60000, 500 << min(self._refresh_retries, 7)))
+
+    def play(self, layout_id, schedule_id, patch=False):
+        """ Switch to a layout, keeping the running regions it shares with the current one.
+
+        With patch, regions that were edited in place keep playing and swap to
+        their new media at the next item boundary.
+        """
         path = "%s/%s%s" % (self._config.saveDir, layout_id, self._config.layout_file_ext)
-        layout = xlf.parse_file(path)
+        layout = xlf.layout_cache.get(path)
         if not layout:
             return False
 
         self._schedule_id = schedule_id
-        self.setStyleSheet('background-color: %s' % layout['bgcolor'])
-        for region in layout['regions']:
-            region['_layout_id'] = layout_id
-            region['_schedule_id'] = self._schedule_id
-            region['_save_dir'] = self._config.saveDir
-            view = RegionView(region, self._central_widget)
+        self.setStyleSheet('background-color: %s' % layout.bgcolor)
+        self.promote(layout, layout_id, 'current')
+
+        running = {}
+        for view in self._region_view:
+            running.setdefault(view.signature, []).append(view)
+
+        plan = []
+        for region in layout.regions:
+            views = running.get(RegionView.signature_of(region, layout_id))
+            view = views.pop(0) if views else None
+            if view:
+                view.set_layout(layout_id, self._schedule_id)
+            plan.append([region, view])
+
+        if patch:
+            for item in plan:
+                if item[1] is None:
+                    item[1] = self._take_patchable(running, item[0])
+                    if item[1]:
+                        item[1].set_layout(layout_id, self._schedule_id)
+                        item[1].patch(item[0])
+
+        # tear down what is not reused before building the new regions
+        for views in running.values():
+            for view in views:
+                view.stop()
+
+        prebuilt = {} if patch else self._take_prebuilt(layout_id)
+        del self._region_view[:]
+        for region, view in plan:
+            if view is None:
+                views = prebuilt.get(RegionView.signature_of(region, layout_id))
+                if views:
+                    view = views.pop(0)
+                    view.set_layout(layout_id, self._schedule_id)
+                else:
+                    view = RegionView(region, layout_id, self._schedule_id, self._config.saveDir,
+                                      self._central_widget)
+                view.play()
             self._region_view.append(view)
-            view.play()
+        for views in prebuilt.values():
+            for view in views:
+                view.stop()
 
         return True
 
+    @staticmethod
+    def _take_patchable(running, region):
+        for views in running.values():
+            for view in views:
+                if view.can_patch(region):
+                    views.remove(view)
+                    return view
+        return None
+
     def stop(self):
         if self._region_view:
             for view in self._region_view:
                 view.stop()
         del self._region_view[:]
+        # the pre-built regions live in the scene of the current widget
+        if self._prebuilt:
+            return
         self._central_widget = None
         self._central_widget = CentralWidget(self._xmds, self)
         self.setCentralWidget(self._central_widget)
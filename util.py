@@ -1,8 +1,8 @@
-from Crypto import Random
-from Crypto.Cipher import ARC4
-from Crypto.Cipher import PKCS1_v1_5
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
+import calendar
+import os
+import resource
+import time
+from hashlib import md5
 
 
 # php openssl_(seal|open)
@@ -13,6 +13,11 @@ from Crypto.PublicKey import RSA
 # print openssl_open(sealed, ekey, open('key.pem').read())
 
 def openssl_seal(plain_data, pub_key):
+    from Crypto import Random
+    from Crypto.Cipher import ARC4
+    from Crypto.Cipher import PKCS1_v1_5
+    from Crypto.Hash import SHA
+    from Crypto.PublicKey import RSA
     # 1. Generate a random key
     nonce = Random.new().read(16)
     rnd_key = SHA.new(nonce).digest()
@@ -28,6 +33,11 @@ def openssl_seal(plain_data, pub_key):
 
 
 def openssl_open(sealed_data, env_key, priv_key):
+    from Crypto import Random
+    from Crypto.Cipher import ARC4
+    from Crypto.Cipher import PKCS1_v1_5
+    from Crypto.Hash import SHA
+    from Crypto.PublicKey import RSA
     # 1. Decrypt the key using RSA and your private key
     rsa = RSA.importKey(priv_key, None)
     size = SHA.digest_size
@@ -38,4 +48,82 @@ def openssl_open(sealed_data, env_key, priv_key):
     rc4 = ARC4.new(d_env_key)
     return rc4.decrypt(sealed_data)
 
-# TODO: md5sum_match, __str_to_epoch, __epoch_to_str, ... should be in this module.
+
+def md5sum_match(file_path, md5sum):
+    if not os.path.isfile(file_path):
+        return False
+
+    # hash in chunks, media files can be larger than the available memory
+    digest = md5()
+    size = 0
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+                size += len(chunk)
+    except IOError:
+        return False
+    if not size:
+        return False
+
+    return digest.hexdigest() == md5sum
+
+
+def str_to_epoch(time_str, time_fmt, tz_offset):
+    seconds = calendar.timegm(time.strptime(time_str, time_fmt))
+    return seconds - tz_offset
+
+
+def epoch_to_str(epoch, time_fmt, tz_offset):
+    seconds = float(epoch)
+    return time.strftime(time_fmt, time.gmtime(seconds + tz_offset))
+
+
+def process_rss(pid='self'):
+    """ Resident set size in bytes from /proc, 0 when not available. """
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+    return pages * resource.getpagesize()
+
+
+def process_cpu_time(pid='self'):
+    """ User plus system cpu time in seconds from /proc, 0 when not available. """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            # the command name may contain spaces, fields start after its ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return 0
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / float(ticks)
+
+
+def process_start_time(pid='self'):
+    """ Epoch seconds the process was started at from /proc, 0 when not available. """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as f:
+            boot_time = [int(line.split()[1]) for line in f if line.startswith('btime ')][0]
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+    return boot_time + int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def mem_available():
+    """ Bytes of memory available without swapping from /proc/meminfo, 0 when not available. """
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    info[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    except (IOError, OSError, ValueError):
+        return 0
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    return info.get('MemFree', 0) + info.get('Cached', 0)
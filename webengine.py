@@ -0,0 +1,85 @@
+import logging
+
+from PySide.QtCore import Qt
+
+import util
+
+log = logging.getLogger('xiboside.webengine')
+
+
+class WebEngine:
+    """ WebKit configuration shared by every WebMediaView.
+
+    WebKit runs in the player process, so the memory budget is checked against
+    the process RSS. Pages are recycled when it is exceeded or after a number of loads.
+    RSS seldom drops after a recycle, above the budget the next recycle waits
+    until it grew again by a tenth of the budget.
+    QtWebKit is only loaded with the first page, it is slow to initialize.
+    """
+    def __init__(self):
+        self._config = None
+        self._ready = False
+        self._network_manager = None
+        self._budget = 0
+        self._max_loads = 0
+        self._recycled_rss = 0
+        self.recycled = 0
+
+    def setup(self, config):
+        self._config = config
+        self._budget = config.webMemoryBudget * 1024 * 1024
+        self._max_loads = config.webPageMaxLoads
+
+    def _init_webkit(self):
+        if self._ready:
+            return
+        self._ready = True
+        from PySide.QtWebKit import QWebSettings
+        settings = QWebSettings.globalSettings()
+        settings.setAttribute(QWebSettings.PluginsEnabled, False)
+        settings.setAttribute(QWebSettings.JavaEnabled, False)
+        settings.setAttribute(QWebSettings.DeveloperExtrasEnabled, False)
+        settings.setAttribute(QWebSettings.OfflineStorageDatabaseEnabled, False)
+        settings.setAttribute(QWebSettings.OfflineWebApplicationCacheEnabled, False)
+        if self._config:
+            capacity = self._config.webObjectCacheSize * 1024 * 1024
+            QWebSettings.setObjectCacheCapacities(0, capacity / 2, capacity)
+        QWebSettings.setMaximumPagesInCache(0)
+
+    def network_manager(self):
+        if self._network_manager is None:
+            from PySide.QtNetwork import QNetworkAccessManager
+            self._network_manager = QNetworkAccessManager()
+        return self._network_manager
+
+    def new_page(self, parent):
+        from PySide.QtWebKit import QWebPage
+        self._init_webkit()
+        page = QWebPage(parent)
+        page.setNetworkAccessManager(self.network_manager())
+        page.mainFrame().setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff)
+        page.mainFrame().setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
+        return page
+
+    def over_budget(self):
+        if self._budget <= 0:
+            return False
+        rss = util.process_rss()
+        return rss > self._budget and rss > self._recycled_rss + self._budget / 10
+
+    def needs_recycle(self, loads):
+        return (0 < self._max_loads <= loads) or self.over_budget()
+
+    def recycle(self, view):
+        """ Give a QWebView a fresh page and drop what WebKit keeps in memory. """
+        old = view.page()
+        view.setPage(self.new_page(view))
+        old.deleteLater()
+        from PySide.QtWebKit import QWebSettings
+        QWebSettings.clearMemoryCaches()
+        self._recycled_rss = util.process_rss()
+        self.recycled += 1
+        log.info('web page recycled (%d so far)' % self.recycled)
+
+
+web_engine = WebEngine()
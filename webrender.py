@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+""" Out of process WebKit renderers, embedded in the player by XEmbed.
+
+The player side is WebRendererPool, the renderer side is this module run as a
+script. A renderer reads one command per line on stdin, like mplayer in
+slave mode:
+
+    embed <window id>    show a fresh view in that window of the player
+    load <n> <url>       load a page in it, 'loaded <n>' is written to stdout once it is
+    blank                load about:blank, scripts and documents are dropped
+    quit
+"""
+import logging
+import os
+import sys
+
+from PySide.QtCore import QObject
+from PySide.QtCore import QProcess
+from PySide.QtCore import Signal
+from PySide.QtCore import Slot
+
+import util
+
+log = logging.getLogger('xiboside.webrender')
+
+
+class WebRenderer(QObject):
+    """ One renderer process, it shows one page at a time. """
+    loaded_signal = Signal()
+
+    def __init__(self, args, parent):
+        super(WebRenderer, self).__init__(parent)
+        self.loads = 0
+        self._process = QProcess(self)
+        self._process.readyReadStandardOutput.connect(self._read)
+        self._process.readyReadStandardError.connect(self._read_errors)
+        self._process.start(sys.executable, [os.path.abspath(__file__)] + args)
+
+    def is_running(self):
+        return self._process.state() != QProcess.NotRunning
+
+    def pid(self):
+        return self._process.pid() if self.is_running() else 0
+
+    def rss(self):
+        return util.process_rss(self.pid()) if self.is_running() else 0
+
+    def embed(self, window_id):
+        self._command('embed %d' % window_id)
+
+    def load(self, url):
+        self.loads += 1
+        self._command('load %d %s' % (self.loads, url))
+
+    def blank(self):
+        self._command('blank')
+
+    def dispose(self):
+        from xlfview import reaper  # xlfview imports this module
+        if self.is_running():
+            self._command('quit')
+            reaper().reap(self._process)
+        self.deleteLater()
+
+    def _command(self, command):
+        self._process.write(command.encode('utf-8') + "\n")
+
+    @Slot()
+    def _read(self):
+        while self._process.canReadLine():
+            fields = str(self._process.readLine()).split()
+            # a page replaced before it finished does not count
+            if 2 == len(fields) and 'loaded' == fields[0] and str(self.loads) == fields[1]:
+                self.loaded_signal.emit()
+
+    @Slot()
+    def _read_errors(self):
+        for line in str(self._process.readAllStandardError()).splitlines():
+            log.debug('renderer %d: %s' % (self.pid(), line))
+
+
+class WebRendererPool(QObject):
+    """ Renderer processes handed to the web media while they play.
+
+    Up to size renderers are kept warm between plays. A renderer returned
+    after max_loads pages or above budget bytes of RSS is replaced, so leaks
+    and hung scripts never reach the player process.
+    """
+    def __init__(self):
+        super(WebRendererPool, self).__init__()
+        self._size = 0
+        self._max_loads = 0
+        self._budget = 0
+        self._args = []
+        self._idle = []
+        self._busy = []
+        self.recycled = 0
+
+    @property
+    def enabled(self):
+        return self._size > 0
+
+    def setup(self, config):
+        self._size = config.webRenderers
+        self._max_loads = config.webPageMaxLoads
+        self._budget = config.webMemoryBudget * 1024 * 1024
+        self._args = ['--object-cache', str(config.webObjectCacheSize)]
+        self._fill()
+
+    def _fill(self):
+        # started ahead, python, PySide and WebKit take a second or more to come up
+        while len(self._idle) < self._size:
+            self._idle.insert(0, WebRenderer(self._args, self))
+
+    def acquire(self):
+        while self._idle:
+            renderer = self._idle.pop()
+            if renderer.is_running():
+                break
+            renderer.dispose()
+        else:
+            renderer = WebRenderer(self._args, self)
+        self._busy.append(renderer)
+        return renderer
+
+    def release(self, renderer):
+        if renderer in self._busy:
+            self._busy.remove(renderer)
+        if not renderer.is_running():
+            renderer.dispose()
+        elif (0 < self._max_loads <= renderer.loads) or (0 < self._budget < renderer.rss()) \
+                or len(self._idle) >= self._size:
+            renderer.dispose()
+            self.recycled += 1
+            log.info('web renderer recycled (%d so far)' % self.recycled)
+            self._fill()
+        else:
+            renderer.blank()
+            self._idle.append(renderer)
+
+    def pids(self):
+        return [pid for pid in (r.pid() for r in self._idle + self._busy) if pid]
+
+    def dispose(self):
+        for renderer in self._idle + self._busy:
+            renderer.dispose()
+        del self._idle[:]
+        del self._busy[:]
+
+
+_web_renderers = None
+
+
+def web_renderers():
+    global _web_renderers
+    if _web_renderers is None:
+        _web_renderers = WebRendererPool()
+    return _web_renderers
+
+
+class _Renderer(QObject):
+    def __init__(self, app):
+        super(_Renderer, self).__init__()
+        from PySide.QtCore import QSocketNotifier
+        self._app = app
+        self._buffer = ''
+        self._widget = None
+        self._view = None
+        self._load = 0
+        self._notifier = QSocketNotifier(sys.stdin.fileno(), QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self._read)
+
+    @Slot()
+    def _read(self):
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            self._app.quit()
+            return
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            command, _, arg = line.strip().partition(' ')
+            if 'embed' == command:
+                self._embed(int(arg))
+            elif 'load' == command and self._view:
+                n, _, url = arg.partition(' ')
+                self._load = int(n)
+                self._view.load(url.decode('utf-8'))
+            elif 'blank' == command and self._view:
+                self._load = 0
+                self._view.load('about:blank')
+            elif 'quit' == command:
+                self._app.quit()
+
+    def _embed(self, window_id):
+        from PySide.QtCore import Qt
+        from PySide.QtGui import QVBoxLayout
+        from PySide.QtGui import QX11EmbedWidget
+        from PySide.QtWebKit import QWebView
+        from webengine import web_engine
+
+        if self._widget is not None:
+            self._widget.deleteLater()
+        self._widget = QX11EmbedWidget()
+        layout = QVBoxLayout(self._widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self._view = QWebView(self._widget)
+        self._view.setPage(web_engine.new_page(self._view))
+        self._view.setContextMenuPolicy(Qt.NoContextMenu)
+        self._view.loadFinished.connect(self._loaded)
+        layout.addWidget(self._view)
+        self._widget.embedInto(window_id)
+        self._widget.show()
+
+    @Slot(bool)
+    def _loaded(self, ok):
+        # failed pages are reported too, the player should not wait for them
+        if self._load:
+            sys.stdout.write('loaded %d\n' % self._load)
+            sys.stdout.flush()
+
+
+def main():
+    import argparse
+    from PySide.QtGui import QApplication
+    from webengine import web_engine
+
+    parser = argparse.ArgumentParser(description="xiboside web renderer")
+    parser.add_argument('--object-cache', dest='webObjectCacheSize', type=int, default=8)
+    args = parser.parse_args()
+    # the pool watches the budget and the loads from the player side
+    args.webMemoryBudget = 0
+    args.webPageMaxLoads = 0
+
+    app = QApplication(sys.argv[:1])
+    web_engine.setup(args)
+    renderer = _Renderer(app)
+    ret = app.exec_()
+    del renderer
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,9 @@ class XiboConfig:
     def __init__(self, path=None):
         self.path = path
         self.saveDir = None
+        # RAM backed copies of the files of the current and next layouts, hotDirSize in MiB (0 disables)
+        self.hotDir = None
+        self.hotDirSize = None
         self.url = None
         self.serverKey = None
         # datetime format (see strptime)
@@ -15,6 +18,41 @@ class XiboConfig:
         self.layout_file_ext = None
         self.xmdsVersion = None
         self.xmrPubUrl = None
+        # xmds requests sent at once by a collect cycle, 1 sends them one after the other
+        self.xmdsConcurrency = None
+        self.mplayer = None
+        # number of screens driven by this process, 0 for every attached screen
+        self.screens = None
+        # decoded image cache budget, in MiB
+        self.imageCacheSize = None
+        self.imageDecodeThreads = None
+        # WebKit object cache and process memory budget, in MiB
+        self.webObjectCacheSize = None
+        self.webMemoryBudget = None
+        self.webPageMaxLoads = None
+        # web media in this many recycled renderer processes (0 renders them in the player)
+        self.webRenderers = None
+        # screenshots every screenshotInterval seconds (0 for on xmr request only), scaled down to
+        # screenshotWidth pixels and encoded at screenshotQuality, lowered to fit screenshotMaxSize KiB
+        self.screenshotInterval = None
+        self.screenshotWidth = None
+        self.screenshotQuality = None
+        self.screenshotMaxSize = None
+        # draw text, ticker and clock media natively instead of with WebKit
+        self.nativeText = None
+        # build the next scheduled layout hidden this many seconds ahead (0 disables),
+        # unless less than prebuildMinFree MiB of memory are available
+        self.prebuildSeconds = None
+        self.prebuildMinFree = None
+        # playback metrics, served on http://metricsHost:metricsPort/metrics (0 disables)
+        self.metricsHost = None
+        self.metricsPort = None
+        self.metricsSampleInterval = None
+        # LAN peer cache: media of saveDir served on peerPort (0 disables), fetched from
+        # the 'host:port' of peers and from the players found by UDP broadcast on peerPort
+        self.peerPort = None
+        self.peers = None
+        self.peerDiscovery = None
 
         self.load()
         pass
@@ -23,6 +61,8 @@ class XiboConfig:
     def defaults(self):
         return {
             'saveDir': '/tmp/xibot',
+            'hotDir': '/dev/shm/xibot',
+            'hotDirSize': 64,
             'url': 'http://localhost:8000',
             'serverKey': 'asdf',
             'strTimeFmt': '%Y-%m-%d %H:%M:%S',
@@ -31,6 +71,28 @@ class XiboConfig:
             'layout_file_ext': '.xml',
             'xmdsVersion': 4,
             'xmrPubUrl': 'tcp://localhost:5550',
+            'xmdsConcurrency': 4,
+            'mplayer': 'mplayer',
+            'screens': 1,
+            'imageCacheSize': 128,
+            'imageDecodeThreads': 2,
+            'webObjectCacheSize': 8,
+            'webMemoryBudget': 384,
+            'webPageMaxLoads': 200,
+            'webRenderers': 0,
+            'nativeText': True,
+            'screenshotInterval': 0,
+            'screenshotWidth': 640,
+            'screenshotQuality': 60,
+            'screenshotMaxSize': 100,
+            'prebuildSeconds': 10,
+            'prebuildMinFree': 256,
+            'metricsHost': '127.0.0.1',
+            'metricsPort': 9696,
+            'metricsSampleInterval': 10,
+            'peerPort': 0,
+            'peers': [],
+            'peerDiscovery': False,
         }
 
     def load(self):
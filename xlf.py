@@ -1,3 +1,5 @@
+import os
+import threading
 from xml.etree import ElementTree
 import logging
 log = logging.getLogger('xiboside.xlf')
@@ -14,12 +16,93 @@ def parse_file(path):
         log.error("%s: %s" % (err.strerror, err.filename))
         return None
     if _xlf.layout:
-        layout = dict(_xlf.layout)
+        layout = _xlf.layout
         _xlf = None
         del _xlf
     return layout
 
 
+# The parsed model is shared between the xmds thread (which parses) and the
+# gui thread (which plays), treat it as read only.
+class Layout(object):
+    __slots__ = ('width', 'height', 'bgcolor', 'background', 'regions', 'tags')
+
+    def __init__(self):
+        self.width = ''
+        self.height = ''
+        self.bgcolor = ''
+        self.background = ''
+        self.regions = ()
+        self.tags = ()
+
+
+class Region(object):
+    __slots__ = ('id', 'width', 'height', 'left', 'top', 'userId', 'zindex', 'media', 'options')
+
+    def __init__(self):
+        self.id = ''
+        self.width = ''
+        self.height = ''
+        self.left = ''
+        self.top = ''
+        self.userId = ''
+        self.zindex = '0'
+        self.media = ()
+        self.options = {}
+
+
+class Media(object):
+    __slots__ = ('id', 'type', 'duration', 'render', 'options', 'raws')
+
+    def __init__(self):
+        self.id = ''
+        self.type = ''
+        self.duration = ''
+        self.render = ''
+        self.options = {}
+        self.raws = {}
+
+
+class LayoutCache:
+    """ Parsed layouts by path, invalidated by the file's mtime and size. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def load(self, path):
+        stamp = self.stamp(path)
+        layout = parse_file(path) if stamp else None
+        with self._lock:
+            if layout:
+                self._entries[path] = (stamp, layout)
+            else:
+                self._entries.pop(path, None)
+        return layout
+
+    def get(self, path):
+        stamp = self.stamp(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and stamp and entry[0] == stamp:
+            return entry[1]
+        return self.load(path)
+
+    def discard(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+layout_cache = LayoutCache()
+
+
 class Xlf:
     def __init__(self, path=None):
         self.layout = None
@@ -29,14 +112,9 @@ class Xlf:
             self.parse(path)
 
     def parse(self, path):
-        layout = {
-            'width': '',
-            'height': '',
-            'bgcolor': '',
-            'background': '',
-            'regions': [],
-            'tags': []
-        }
+        layout = Layout()
+        regions = []
+        tags = []
         tree = ElementTree.parse(path)
         root = tree.getroot()
 
@@ -45,18 +123,20 @@ class Xlf:
             return None
 
         for k, v in root.attrib.iteritems():
-            if k in layout:
-                layout[k] = v
+            if k in Layout.__slots__ and k not in ('regions', 'tags'):
+                setattr(layout, k, v)
 
         for child in root:
             if 'region' == child.tag:
                 region = self.__parse_region(child)
                 if region:
-                    layout['regions'].append(region)
+                    regions.append(region)
             elif 'tags' == child.tag:
                 for tag in child:
-                    layout['tags'].append(tag.text)
+                    tags.append(tag.text)
 
+        layout.regions = tuple(regions)
+        layout.tags = tuple(tags)
         self.layout = layout
         return layout
 
@@ -65,31 +145,23 @@ class Xlf:
             self.region = None
             return None
 
-        region = {
-            'id': '',
-            'width': '',
-            'height': '',
-            'left': '',
-            'top': '',
-            'userId': '',
-            'zindex': '0',
-            'media': [],
-            'options': {}
-        }
+        region = Region()
+        media = []
         for k, v in node.attrib.iteritems():
-            if k in region:
-                region[k] = v
+            if k in Region.__slots__ and k not in ('media', 'options'):
+                setattr(region, k, v)
 
         for child in node:
             if 'media' == child.tag:
-                media = self.__parse_media(child)
-                if media:
-                    region['media'].append(media)
+                m = self.__parse_media(child)
+                if m:
+                    media.append(m)
             elif 'options' == child.tag:
                 for option in child:
                     if option.text:
-                        region['options'][option.tag] = option.text
+                        region.options[option.tag] = option.text
 
+        region.media = tuple(media)
         self.region = region
         return region
 
@@ -98,27 +170,20 @@ class Xlf:
             self.media = None
             return None
 
-        media = {
-            'id': '',
-            'type': '',
-            'duration': '',
-            'render': '',
-            'options': {},
-            'raws': {}
-        }
+        media = Media()
         for k, v in node.attrib.iteritems():
-            if k in media:
-                media[k] = v
+            if k in Media.__slots__ and k not in ('options', 'raws'):
+                setattr(media, k, v)
 
         for child in node:
             if 'options' == child.tag:
                 for option in child:
                     if option.text:
-                        media['options'][option.tag] = option.text
+                        media.options[option.tag] = option.text
             elif 'raw' == child.tag:
                 for raw in child:
                     if raw.text:
-                        media['raws'][raw.tag] = raw.text
+                        media.raws[raw.tag] = raw.text
 
         self.media = media
         return media
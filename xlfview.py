@@ -1,41 +1,111 @@
 import os
-import signal
+import re
 import time
 
 from PySide.QtCore import QObject
 from PySide.QtCore import QProcess
 from PySide.QtCore import QRect
+from PySide.QtCore import QRectF
 from PySide.QtCore import QTimer
 from PySide.QtCore import QUrl
 from PySide.QtCore import Qt
 from PySide.QtCore import SIGNAL
 from PySide.QtCore import Signal
 from PySide.QtCore import Slot
-from PySide.QtGui import QImage
-from PySide.QtGui import QLabel
+from PySide.QtGui import QColor
+from PySide.QtGui import QGraphicsItem
+from PySide.QtGui import QGraphicsPixmapItem
+from PySide.QtGui import QGraphicsRectItem
+from PySide.QtGui import QPainter
+from PySide.QtGui import QPen
 from PySide.QtGui import QPixmap
+from PySide.QtGui import QTextDocument
 from PySide.QtGui import QWidget
-from PySide.QtWebKit import QWebView
+
+from catalog import media_catalog
+from imgcache import image_loader
+from metrics import first_pixel
+from metrics import metrics
+from store import hot_store
+from webengine import web_engine
+from webrender import web_renderers
+
+
+class Reaper(QObject):
+    """ Collect processes that were asked to quit, without waiting for them.
+
+    A straggler is terminated once its grace period is over, then killed.
+    """
+    def __init__(self, grace=2.0):
+        super(Reaper, self).__init__()
+        self._grace = grace
+        self._processes = []
+        self._timer = QTimer(self)
+        self._timer.setInterval(250)
+        self._timer.timeout.connect(self._check)
+
+    def reap(self, process):
+        # the owner is about to be deleted, and deleting a running QProcess blocks.
+        process.setParent(self)
+        self._processes.append((process, time.time() + self._grace))
+        self._timer.start()
+
+    def flush(self, timeout=500):
+        """ Blocking, for use on exit only. """
+        for process, deadline in self._processes:
+            if not process.waitForFinished(timeout):
+                process.kill()
+                process.waitForFinished(timeout)
+        del self._processes[:]
+        self._timer.stop()
+
+    @Slot()
+    def _check(self):
+        now = time.time()
+        alive = []
+        for process, deadline in self._processes:
+            if process.state() == QProcess.NotRunning:
+                process.deleteLater()
+                continue
+            if now > deadline + self._grace:
+                process.kill()
+            elif now > deadline:
+                process.terminate()
+            alive.append((process, deadline))
+
+        self._processes = alive
+        if not alive:
+            self._timer.stop()
+
+
+_reaper = None
+
+
+def reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = Reaper()
+    return _reaper
 
 
 class MediaView(QObject):
     started_signal = Signal()
     finished_signal = Signal()
 
-    def __init__(self, media, parent):
+    def __init__(self, media, region, parent):
         super(MediaView, self).__init__(parent)
         self._parent = parent
-        self._id = media['id']
-        self._type = media['type']
-        self._duration = media['duration']
-        self._render = media['render']
-        self._options = media['options']
-        self._raws = media['raws']
-
-        self._layout_id = media['_layout_id']
-        self._schedule_id = media['_schedule_id']
-        self._region_id = media['_region_id']
-        self._save_dir = media['_save_dir']
+        self._id = media.id
+        self._type = media.type
+        self._duration = media.duration
+        self._render = media.render
+        self._options = media.options
+        self._raws = media.raws
+
+        self._layout_id = region.layout_id
+        self._schedule_id = region.schedule_id
+        self._region_id = region.id
+        self._save_dir = region.save_dir
 
         self._widget = None
         self._play_timer = QTimer(self)
@@ -55,16 +125,20 @@ class MediaView(QObject):
         self.connect(self._play_timer, SIGNAL("timeout()"), self.stop)
 
     @staticmethod
-    def make(media, parent):
-        if 'type' not in media:
+    def make(media, region, parent):
+        if not media.type:
             return None
 
-        if 'image' == media['type']:
-            view = ImageMediaView(media, parent)
-        elif 'video' == media['type']:
-            view = VideoMediaView(media, parent)
+        if 'image' == media.type:
+            view = ImageMediaView(media, region, parent)
+        elif 'video' == media.type:
+            view = VideoMediaView(media, region, parent)
+        elif TextMediaView.supports(media):
+            view = TextMediaView(media, region, parent)
+        elif web_renderers().enabled:
+            view = RemoteWebMediaView(media, region, parent)
         else:
-            view = WebMediaView(media, parent)
+            view = WebMediaView(media, region, parent)
 
         return view
 
@@ -72,18 +146,42 @@ class MediaView(QObject):
     def play(self):
         pass
 
+    def prefetch(self):
+        pass
+
+    def prepare(self):
+        """ Warm up hidden before the first play, the layout is built ahead of its start. """
+        self.prefetch()
+
+    def set_layout(self, layout_id, schedule_id):
+        self._layout_id = layout_id
+        self._schedule_id = schedule_id
+
+    @property
+    def media_type(self):
+        return self._type
+
+    def dispose(self):
+        if self._widget is not None:
+            self._delete_widget()
+        self.deleteLater()
+
+    def _delete_widget(self):
+        if hasattr(self._widget, 'deleteLater'):
+            self._widget.deleteLater()
+        elif self._widget.scene():
+            # plain graphics items are not QObjects, the scene owns them
+            self._widget.scene().removeItem(self._widget)
+        self._widget = None
+
     @Slot()
     def stop(self, delete_widget=False):
         if self.is_finished():
             return False
         if self._widget:
-            tries = 10
-            while tries > 0 and not self._widget.close():
-                tries -= 1
-                time.sleep(0.05)
+            self._widget.hide()
             if delete_widget:
-                del self._widget
-                self._widget = None
+                self._delete_widget()
 
         self.finished_signal.emit()
         return True
@@ -96,6 +194,9 @@ class MediaView(QObject):
     def mark_finished(self):
         if not self.is_finished():
             self._finished = time.time()
+            # never on screen, nothing to report
+            if not self.is_started():
+                return
             self._parent.queue_stats(
                 'media',
                 self._started,
@@ -114,58 +215,257 @@ class MediaView(QObject):
     def is_playing(self):
         return self.is_started() and not self.is_finished()
 
-    def set_default_widget_prop(self):
-        if self._widget is not None:
-            self._widget.setAttribute(Qt.WA_DeleteOnClose, False)
-            self._widget.setFocusPolicy(Qt.NoFocus)
-            self._widget.setContextMenuPolicy(Qt.NoContextMenu)
-            self._widget.setObjectName('%s-widget' % self.objectName())
+    def add_item(self, item, region):
+        """ Put a graphics item of this media in the scene, stacked by region z-index. """
+        self._widget = item
+        item.setPos(region.geometry.topLeft())
+        item.setZValue(region.zindex)
+        item.setAcceptedMouseButtons(Qt.NoButton)
+        item.hide()
+        self._parent.scene().addItem(item)
 
 
 class ImageMediaView(MediaView):
-    def __init__(self, media, parent):
-        super(ImageMediaView, self).__init__(media, parent)
-        self._widget = QLabel(parent)
-        self._widget.setGeometry(media['_geometry'])
-        self._img = QImage()
-        self.set_default_widget_prop()
+    def __init__(self, media, region, parent):
+        super(ImageMediaView, self).__init__(media, region, parent)
+        self.add_item(QGraphicsPixmapItem(), region)
+        self._size = region.geometry.size()
+        self._path = "%s/%s" % (self._save_dir, self._options['uri'])
+        self._source = self._path
+        self._region = region
+        self._waiting = False
+        self._played_at = 0
+        self._loader = image_loader()
+        self._loader.ready_signal.connect(self._image_ready)
+
+    def prefetch(self):
+        self._request()
+
+    def _request(self):
+        # the display sized copy made at download time when there is one. Cached under its
+        # saveDir path, the hot copy may appear between a prefetch and the play.
+        self._source = media_catalog(self._save_dir).derivative(self._path)
+        return self._loader.request(self._source, self._size.width(), self._size.height(),
+                                    hot_store.resolve(self._source))
 
     @Slot()
     def play(self):
         self._finished = 0
-        path = "%s/%s" % (self._save_dir, self._options['uri'])
-        rect = self._widget.geometry()
-        self._img.load(path)
-        self._img = self._img.scaled(rect.width(), rect.height(),
-                                     Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
-
-        self._widget.setPixmap(QPixmap.fromImage(self._img))
-        self._widget.show()
-        self._widget.raise_()
-
+        self._started = 0
+        self._played_at = time.time()
         self._play_timer.setInterval(int(float(self._duration) * 1000))
         self._play_timer.start()
+
+        pixmap = self._request()
+        if pixmap is not None:
+            self._show(pixmap)
+            return
+
+        # not decoded yet, keep the previous frame of the region rather than blocking.
+        # started_signal is emitted once the image is actually on screen.
+        self._waiting = True
+        if self._region.last_pixmap is not None:
+            self._widget.setPixmap(self._region.last_pixmap)
+            self._widget.show()
+
+    @Slot()
+    def stop(self, delete_widget=False):
+        if self._waiting:
+            # the decode did not make it within the duration, the image was never shown
+            self._waiting = False
+            metrics.observe('xibo_image_decode_miss_seconds', time.time() - self._played_at)
+        return super(ImageMediaView, self).stop(delete_widget)
+
+    def is_playing(self):
+        return self._waiting or super(ImageMediaView, self).is_playing()
+
+    @Slot(str, int, int, object)
+    def _image_ready(self, path, width, height, pixmap):
+        if not self._waiting or path != self._source:
+            return
+        if (width, height) == (self._size.width(), self._size.height()):
+            self._show(pixmap)
+
+    def _show(self, pixmap):
+        self._waiting = False
+        self._widget.setPixmap(pixmap)
+        self._region.last_pixmap = pixmap
+        self._widget.show()
         self.started_signal.emit()
 
+    def dispose(self):
+        # the loader is process wide, it would keep calling every view ever built
+        self._loader.ready_signal.disconnect(self._image_ready)
+        self._waiting = False
+        super(ImageMediaView, self).dispose()
 
-class VideoMediaView(MediaView):
-    def __init__(self, media, parent):
-        super(VideoMediaView, self).__init__(media, parent)
+
+class VideoPlayer(QObject):
+    """ A slave mode mplayer kept alive for the lifetime of a region.
+
+    Videos are fed with loadfile, and a stopped video is parked paused on its
+    first frame so that replaying it (looping) is just an unpause. Paths are the
+    saveDir ones, the hot copy is only what mplayer opens.
+    """
+    started_signal = Signal()
+    length_signal = Signal(float)
+    finished_signal = Signal()
+    command = 'mplayer'
+
+    def __init__(self, geometry, parent):
+        super(VideoPlayer, self).__init__(parent)
         self._widget = QWidget(parent)
-        self._process = QProcess(self._widget)
-        self._process.setObjectName('%s-process' % self.objectName())
-        self._std_out = []
+        self._widget.setGeometry(geometry)
+        self._widget.setAttribute(Qt.WA_DeleteOnClose, False)
+        self._widget.setFocusPolicy(Qt.NoFocus)
+        self._widget.setContextMenuPolicy(Qt.NoContextMenu)
+        self._widget.hide()
+        self._process = QProcess(self)
+        self._buffer = ''
+        self._path = None
+        self._mtime = None
+        self._loading = False
+        self._paused = False
+        self.length = 0
+        self.owner = None
+
+        self._process.readyReadStandardOutput.connect(self._read_std_out)
+        self._process.finished.connect(self._process_finished)
+        self.connect(self._process, SIGNAL("error(QProcess::ProcessError)"), self._process_finished)
+
+    @property
+    def widget(self):
+        return self._widget
+
+    def is_running(self):
+        return self._process.state() != QProcess.NotRunning
+
+    def load(self, path, mute, owner):
+        self.owner = owner
+        if not self.is_running():
+            self._spawn()
+
+        self._widget.show()
+        self._command('pausing_keep mute %d' % int(mute))
+        mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+        if path == self._path and mtime == self._mtime and self._paused:
+            # any command without the pausing prefix resumes playback
+            self._paused = False
+            self._command('seek 0 2')
+            self._widget.raise_()
+            self.started_signal.emit()
+        elif path == self._path and mtime == self._mtime and self._loading:
+            # preloaded and still opening, it starts on 'Starting playback'
+            pass
+        else:
+            self._path = path
+            self._mtime = mtime
+            self._paused = False
+            self._loading = True
+            self.length = 0
+            self._command('loadfile "%s"' % hot_store.resolve(path))
+
+    def preload(self, path):
+        """ Open a file and park it paused on its first frame, load() then only resumes it. """
+        if self.owner is not None or path == self._path:
+            return
+        if not self.is_running():
+            self._spawn()
+        self._command('pausing_keep mute 1')
+        self._path = path
+        self._mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+        self._paused = False
+        self._loading = True
+        self.length = 0
+        self._command('loadfile "%s"' % hot_store.resolve(path))
+
+    def pid(self):
+        return self._process.pid() if self.is_running() else 0
+
+    def pause(self):
+        self.owner = None
+        self._widget.hide()
+        if self.is_running() and self._path and not self._loading and not self._paused:
+            self._command('pausing seek 0 2')
+            self._paused = True
+
+    def kill(self):
+        if self.is_running():
+            self._process.terminate()
+
+    def dispose(self):
+        self.owner = None
+        self._widget.hide()
+        if self.is_running():
+            self._command('quit')
+            self._process.blockSignals(True)
+            reaper().reap(self._process)
+        self._widget.deleteLater()
+        self.deleteLater()
+
+    def _spawn(self):
+        args = [
+            '-slave', '-idle', '-identify', '-msglevel', 'global=6',
+            '-input', 'nodefault-bindings:conf=/dev/null',
+            '-wid', str(int(self._widget.winId()))
+        ]
+        self._buffer = ''
+        self._path = None
+        self._loading = False
+        self._paused = False
+        self._process.start(self.command, args)
+
+    def _command(self, command):
+        self._process.write(command + "\n")
+
+    @Slot()
+    def _read_std_out(self):
+        lines = (self._buffer + self._process.readAllStandardOutput().data()).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line.startswith('Starting playback'):
+                self._loading = False
+                if self.owner is None:  # stopped while loading
+                    self._command('pausing seek 0 2')
+                    self._paused = True
+                else:
+                    self._widget.raise_()
+                    self.started_signal.emit()
+            elif line.startswith('ID_LENGTH='):
+                self.length = float(line.split('=', 1)[1])
+                self.length_signal.emit(self.length)
+            elif line.startswith('EOF code: 1') and not self._loading:
+                # idle mode unloads the file at its end
+                self._path = None
+                self._paused = False
+                if self.owner is not None:
+                    self.finished_signal.emit()
+
+    @Slot()
+    def _process_finished(self, *args):
+        self._path = None
+        self._loading = False
+        self._paused = False
+        if self.owner is not None:
+            self.finished_signal.emit()
+
+
+class VideoMediaView(MediaView):
+    def __init__(self, media, region, parent):
+        super(VideoMediaView, self).__init__(media, region, parent)
+        self._player = region.player()
+        self._widget = self._player.widget
+        self._length = 0
         self._errors = []
-        self._stopping = False
+        self._played_at = 0
         self._mute = False
         if 'mute' in self._options:
             self._mute = bool(int(self._options['mute']))
 
-        self._widget.setGeometry(media['_geometry'])
-        self.connect(self._process, SIGNAL("error()"), self._process_error)
-        self.connect(self._process, SIGNAL("finished()"), self.stop)
-        self.connect(self._process, SIGNAL("readyReadStandardOutput()"), self.__grep_std_out)
-        self.set_default_widget_prop()
+        self._player.started_signal.connect(self._playback_started)
+        self._player.length_signal.connect(self._set_length)
+        self._player.finished_signal.connect(self._playback_finished)
 
         self._stop_timer = QTimer(self)
         self._stop_timer.setSingleShot(True)
@@ -174,137 +474,511 @@ class VideoMediaView(MediaView):
 
     @Slot()
     def _force_stop(self):
-        os.kill(self._process.pid(), signal.SIGTERM)
-        self._stopping = False
+        self._player.kill()
         if not self.is_started():
-            self.started_signal.emit()
-        super(VideoMediaView, self).stop()
-
-    @Slot(object)
-    def _process_error(self, err):
-        self._errors.append(err)
+            # mplayer never showed it, the view is stopped without a start to report
+            metrics.observe('xibo_video_start_miss_seconds', time.time() - self._played_at)
         self.stop()
 
+    def _owns_player(self):
+        return self._player.owner is self
+
+    def prepare(self):
+        self._player.preload("%s/%s" % (self._save_dir, self._options['uri']))
+
     @Slot()
     def play(self):
         self._finished = 0
+        self._started = 0
+        self._played_at = time.time()
         path = "%s/%s" % (self._save_dir, self._options['uri'])
-        self._widget.show()
-        args = [
-            '-slave', '-identify', '-input',
-            'nodefault-bindings:conf=/dev/null',
-            '-wid', str(int(self._widget.winId())),
-            path
-        ]
-        if self._mute:
-            args += ['-ao', 'null']
-
-        self._process.start('mplayer', args)
+        # known from the download time probe, no need to wait for mplayer
+        self._length = media_catalog(self._save_dir).duration(path)
         self._stop_timer.start()
+        self._player.load(path, self._mute, self)
 
     @Slot()
     def stop(self, delete_widget=False):
-        if self._stopping or self.is_finished():
+        if self.is_finished():
             return False
-        self._stop_timer.start()
-        self._stopping = True
-        if self._process.state() == QProcess.ProcessState.Running:
-            self._process.write("quit\n")
-            self._process.waitForFinished(50)
-            self._process.close()
-
-        super(VideoMediaView, self).stop(delete_widget)
-        self._stopping = False
         self._stop_timer.stop()
-        return True
+        self._play_timer.stop()
+        if self._owns_player():
+            self._player.pause()
+
+        # the widget belongs to the region's player, never delete it here.
+        return super(VideoMediaView, self).stop()
+
+    def dispose(self):
+        self._widget = None
+        super(VideoMediaView, self).dispose()
 
     @Slot()
-    def __grep_std_out(self):
-        lines = self._process.readAllStandardOutput().split("\n")
-        for line in lines:
-            if not line.isEmpty():
-                if line.startsWith("Starting playback"):
-                    self._widget.raise_()
-                    self._play_timer.start()
-                    self.started_signal.emit()
-                    self._stop_timer.stop()
-                else:
-                    part = line.split("=")
-                    if 'ID_LENGTH' == part[0]:
-                        if float(self._duration) > 0:  # user set the video duration manually.
-                            self._play_timer.setInterval(int(1000 * float(self._duration)))
-                        else:  # use duration found by mplayer.
-                            self._play_timer.setInterval(int(1000 * float(part[1])))
+    def _playback_started(self):
+        if not self._owns_player():
+            return
+        self._stop_timer.stop()
+        self._set_length(self._player.length or self._length)
+        if self._play_timer.interval() > 0:
+            self._play_timer.start()
+        self.started_signal.emit()
+
+    @Slot(float)
+    def _set_length(self, length):
+        if not self._owns_player():
+            return
+        if float(self._duration) > 0:  # user set the video duration manually.
+            self._play_timer.setInterval(int(1000 * float(self._duration)))
+        elif length > 0:  # use duration found by mplayer.
+            self._play_timer.setInterval(int(1000 * length))
+
+    @Slot()
+    def _playback_finished(self):
+        if self._owns_player():
+            self.stop()
+
+
+class TextMediaView(MediaView):
+    """ text, ticker and clock media drawn natively in the scene, no WebKit.
+
+    The content is rendered once into a pixmap strip, scrolling only moves
+    the strip inside its clipped region. Clocks are redrawn once a second.
+    Anything else, flip clocks or the other html media, stays with WebMediaView.
+    """
+    enabled = True
+    frame_interval = 16
+    # moment.js tokens of the Xibo digital clock format
+    _CLOCK_TOKENS = {
+        'YYYY': '%Y', 'MMMM': '%B', 'MMM': '%b', 'MM': '%m', 'DD': '%d', 'dddd': '%A',
+        'ddd': '%a', 'HH': '%H', 'hh': '%I', 'mm': '%M', 'ss': '%S', 'A': '%p',
+    }
+    _CLOCK_TOKEN = re.compile('|'.join(sorted(_CLOCK_TOKENS, key=len, reverse=True)))
+    _SCRIPT = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+    _TOKEN = re.compile(r'\[([^\]]*)\]')
+
+    def __init__(self, media, region, parent):
+        super(TextMediaView, self).__init__(media, region, parent)
+        self._size = region.geometry.size()
+        self.add_item(QGraphicsRectItem(0, 0, self._size.width(), self._size.height()), region)
+        self._widget.setPen(QPen(Qt.NoPen))
+        self._widget.setFlag(QGraphicsItem.ItemClipsChildrenToShape, True)
+        self._strip = QGraphicsPixmapItem(self._widget)
+        self._direction = self._options.get('direction') or 'none'
+        # pixels per 85 ms, the default scroll delay of the marquees of the html renderer
+        self._speed = float(self._options.get('scrollSpeed') or 2) * 1000 / 85
+        self._scroll_started = 0
+        self._rendered = False
+        self._frame_timer = QTimer(self)
+        self._frame_timer.timeout.connect(self._frame)
+
+    @staticmethod
+    def supports(media):
+        if not TextMediaView.enabled:
+            return False
+        if 'text' == media.type:
+            return bool(media.raws.get('text'))
+        if 'ticker' == media.type:
+            return True
+        if 'clock' == media.type:
+            return str(media.options.get('clockTypeId') or '1') in ('1', '2')
+        return False
+
+    @Slot()
+    def play(self):
+        self._finished = 0
+        if 'clock' == self._type:
+            self._frame_timer.setInterval(1000)
+        elif self._direction in ('left', 'right', 'up', 'down'):
+            self._frame_timer.setInterval(self.frame_interval)
+        else:
+            self._frame_timer.setInterval(0)
+        if not self._rendered:
+            self._render_content()
+        self._rendered = False
+        self._scroll_started = time.time()
+        self._frame()
+        if self._frame_timer.interval():
+            self._frame_timer.start()
+        self._widget.show()
+
+        self._play_timer.setInterval(int(float(self._duration) * 1000))
+        self._play_timer.start()
+        self.started_signal.emit()
+
+    def prepare(self):
+        self._render_content()
+        self._rendered = True
+
+    @Slot()
+    def stop(self, delete_widget=False):
+        self._frame_timer.stop()
+        return super(TextMediaView, self).stop(delete_widget)
+
+    def _render_content(self):
+        if 'clock' == self._type:
+            return
+        if 'text' == self._type:
+            html = self._raws.get('text') or ''
+        else:
+            path = "%s/%s_%s_%s.html" % (self._save_dir, self._layout_id, self._region_id, self._id)
+            try:
+                with open(hot_store.resolve(path)) as f:
+                    html = f.read().decode('utf-8', 'replace')
+            except IOError:
+                html = ''
+        self._strip.setPixmap(self._render_html(self._SCRIPT.sub('', html)))
+
+    def _render_html(self, html):
+        doc = QTextDocument()
+        doc.setDocumentMargin(0)
+        doc.setHtml(html)
+        if self._direction in ('left', 'right'):
+            # one line, as long as it needs to be
+            doc.setTextWidth(doc.idealWidth() + 1)
+        else:
+            doc.setTextWidth(self._size.width())
+        size = doc.size().toSize()
+        pixmap = QPixmap(max(1, size.width()), max(1, size.height()))
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        doc.drawContents(painter)
+        painter.end()
+        return pixmap
+
+    @Slot()
+    def _frame(self):
+        if 'clock' == self._type:
+            self._draw_clock()
+            return
+        strip = self._strip.pixmap()
+        width, height = self._size.width(), self._size.height()
+        offset = (time.time() - self._scroll_started) * self._speed
+        if 'left' == self._direction:
+            self._strip.setPos(width - offset % (width + strip.width()), 0)
+        elif 'right' == self._direction:
+            self._strip.setPos(offset % (width + strip.width()) - strip.width(), 0)
+        elif 'up' == self._direction:
+            self._strip.setPos(0, height - offset % (height + strip.height()))
+        elif 'down' == self._direction:
+            self._strip.setPos(0, offset % (height + strip.height()) - strip.height())
+        else:
+            self._strip.setPos(0, 0)
+
+    def _clock_time(self):
+        now = time.time()
+        if self._options.get('offset'):
+            now += float(self._options['offset']) * 60
+        return time.localtime(now)
+
+    def _draw_clock(self):
+        now = self._clock_time()
+        if '2' == str(self._options.get('clockTypeId') or '1'):
+            fmt = self._raws.get('format') or '[HH:mm]'
+            self._strip.setPixmap(self._render_html(self._TOKEN.sub(lambda m: self._strftime(m.group(1), now), fmt)))
+            return
+
+        side = min(self._size.width(), self._size.height())
+        pixmap = QPixmap(self._size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(self._size.width() / 2.0, self._size.height() / 2.0)
+        painter.scale(side / 200.0, side / 200.0)
+        painter.setPen(QPen(QColor('#ffffff'), 4))
+        painter.drawEllipse(-96, -96, 192, 192)
+        for i in range(12):
+            painter.drawLine(0, -88, 0, -96 if i % 3 else -76)
+            painter.rotate(30)
+        for angle, length, width in ((30 * (now.tm_hour % 12) + now.tm_min / 2.0, 50, 8),
+                                     (6 * now.tm_min + now.tm_sec / 10.0, 75, 5),
+                                     (6 * now.tm_sec, 85, 2)):
+            painter.save()
+            painter.rotate(angle)
+            painter.setPen(QPen(painter.pen().color(), width, Qt.SolidLine, Qt.RoundCap))
+            painter.drawLine(0, 10, 0, -length)
+            painter.restore()
+        painter.end()
+        self._strip.setPixmap(pixmap)
+
+    def _strftime(self, fmt, now):
+        fmt = self._CLOCK_TOKEN.sub(lambda m: self._CLOCK_TOKENS[m.group(0)], fmt.replace('%', '%%'))
+        return time.strftime(fmt, now)
 
 
 class WebMediaView(MediaView):
-    def __init__(self, media, parent):
-        super(WebMediaView, self).__init__(media, parent)
-        self._widget = QWebView(parent)
-        self._widget.setGeometry(media['_geometry'])
-        self.set_default_widget_prop()
-        self._widget.setDisabled(True)
-        self._widget.page().mainFrame().setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff)
-        self._widget.page().mainFrame().setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
+    def __init__(self, media, region, parent):
+        super(WebMediaView, self).__init__(media, region, parent)
+        from PySide.QtWebKit import QGraphicsWebView
+        self.add_item(QGraphicsWebView(), region)
+        self._widget.setPage(web_engine.new_page(self._widget))
+        self._widget.resize(QRectF(region.geometry).size())
+        # repaint from a pixmap, only the areas the page updates are rendered again
+        self._widget.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self._widget.setEnabled(False)
+        self._loads = 0
+        self._loaded = False
+
+    def prepare(self):
+        self._load()
+        self._loaded = True
 
     @Slot()
     def play(self):
         self._finished = 0
+        if not self._loaded:
+            self._load()
+        self._loaded = False
+        self._widget.show()
+
+        self._play_timer.setInterval(int(float(self._duration) * 1000))
+        self._play_timer.start()
+        self.started_signal.emit()
+
+    def _load(self):
+        if web_engine.needs_recycle(self._loads):
+            web_engine.recycle(self._widget)
+            self._loads = 0
+        self._loads += 1
+        self._widget.load("about:blank")
+        self._widget.load(self._url())
+
+    def _url(self):
+        if 'webpage' == str(self._type) and 'native' == str(self._render):
+            return QUrl.fromPercentEncoding(self._options['uri'])
         path = "%s/%s_%s_%s.html" % (
             self._save_dir,
             self._layout_id, self._region_id, self._id
         )
-        self._widget.load("about:blank")
-        if 'webpage' == str(self._type) and 'native' == str(self._render):
-            url = self._options['uri']
-            self._widget.load(QUrl.fromPercentEncoding(url))
-        else:
-            self._widget.load('file://' + path)
+        return 'file://' + path
+
+    @Slot()
+    def stop(self, delete_widget=False):
+        if not self.is_finished() and self._widget is not None:
+            # don't keep scripts and documents alive in a hidden page
+            self._widget.load('about:blank')
+        return super(WebMediaView, self).stop(delete_widget)
+
+
+class RemoteWebMediaView(WebMediaView):
+    """ A page rendered by a WebRenderer process, embedded in a native window.
+
+    Like videos, these windows are above the scene whatever the z-index.
+    started_signal waits for the renderer to report the page loaded.
+    """
+    def __init__(self, media, region, parent):
+        MediaView.__init__(self, media, region, parent)
+        from PySide.QtGui import QX11EmbedContainer
+        self._widget = QX11EmbedContainer(parent.viewport())
+        self._widget.setGeometry(region.geometry)
+        self._widget.setFocusPolicy(Qt.NoFocus)
+        self._widget.hide()
+        self._renderer = None
+        self._loaded = False
+        self._page_ready = False
+        self._waiting = False
+
+    def _load(self):
+        if self._renderer is None:
+            self._renderer = web_renderers().acquire()
+            self._renderer.loaded_signal.connect(self._page_loaded)
+            self._renderer.embed(int(self._widget.winId()))
+        self._page_ready = False
+        self._renderer.load(self._url())
+
+    @Slot()
+    def play(self):
+        self._finished = 0
+        self._started = 0
+        if not self._loaded:
+            self._load()
+        self._loaded = False
         self._widget.show()
         self._widget.raise_()
 
         self._play_timer.setInterval(int(float(self._duration) * 1000))
         self._play_timer.start()
-        self.started_signal.emit()
+        self._waiting = not self._page_ready
+        if self._page_ready:
+            self.started_signal.emit()
+
+    @Slot()
+    def _page_loaded(self):
+        self._page_ready = True
+        if self._waiting:
+            self._waiting = False
+            self.started_signal.emit()
+
+    @Slot()
+    def stop(self, delete_widget=False):
+        if self.is_finished():
+            return False
+        self._waiting = False
+        self._release()
+        return MediaView.stop(self, delete_widget)
+
+    def is_playing(self):
+        return self._waiting or super(RemoteWebMediaView, self).is_playing()
+
+    def dispose(self):
+        self._release()
+        super(RemoteWebMediaView, self).dispose()
+
+    def _release(self):
+        if self._renderer is not None:
+            self._renderer.loaded_signal.disconnect(self._page_loaded)
+            web_renderers().release(self._renderer)
+            self._renderer = None
+        self._page_ready = False
 
 
 class RegionView:
-    def __init__(self, region, parent):
+    def __init__(self, region, layout_id, schedule_id, save_dir, parent):
         self._parent = parent
-        self._id = region['id']
-        self._width = region['width']
-        self._height = region['height']
-        self._left = region['left']
-        self._top = region['top']
-        self._media = region['media']
-        self._options = region['options']
+        self.signature = RegionView.signature_of(region, layout_id)
+        self._id = region.id
+        self._zindex = int(float(region.zindex or 0))
+        self._media = region.media
+        self._options = region.options
+        self._geometry = QRect(
+            int(float(region.left)), int(float(region.top)),
+            int(float(region.width)), int(float(region.height))
+        )
         self._loop = False
         if 'loop' in self._options:
             self._loop = bool(int(self._options['loop']))
 
-        self._layout_id = region['_layout_id']
-        self._schedule_id = region['_schedule_id']
-        self._save_dir = region['_save_dir']
+        self._layout_id = layout_id
+        self._schedule_id = schedule_id
+        self._save_dir = save_dir
 
         self._media_view = None
+        # the last image shown, what an image still decoding keeps on screen
+        self.last_pixmap = None
         self._media_index = 0
         self._media_length = 0
+        self._requested_at = 0
+        self._finished_at = 0
         self._stop = False
+        self._player = None
+        self._pending = None
+        self._populate_media()
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def layout_id(self):
+        return self._layout_id
+
+    @property
+    def schedule_id(self):
+        return self._schedule_id
+
+    @property
+    def save_dir(self):
+        return self._save_dir
+
+    @property
+    def geometry(self):
+        return self._geometry
+
+    @property
+    def zindex(self):
+        return self._zindex
+
+    def player_pid(self):
+        return self._player.pid() if self._player else 0
+
+    def player(self):
+        if self._player is None:
+            # mplayer draws in a native window, above the scene whatever the z-index
+            self._player = VideoPlayer(self._geometry, self._parent.viewport())
+        return self._player
+
+    @staticmethod
+    def signature_of(region, layout_id):
+        """ Everything that makes a region look and behave the way it does.
+
+        Two regions with the same signature are interchangeable, even across layouts.
+        """
+        media = []
+        for m in region.media:
+            # resources are downloaded per layout/region, see XmdsThread.__download
+            resource = None
+            if m.type not in ('image', 'video') and not ('webpage' == m.type and 'native' == m.render):
+                resource = (layout_id, region.id)
+            media.append((
+                m.id, m.type, m.render, m.duration,
+                tuple(sorted(m.options.items())), tuple(sorted(m.raws.items())), resource
+            ))
+
+        return (
+            region.width, region.height, region.left, region.top, region.zindex,
+            tuple(sorted(region.options.items())), tuple(media)
+        )
+
+    @staticmethod
+    def files_of(region, layout_id, save_dir, derived=True):
+        """ The files of saveDir a region reads while it plays, the downloaded ones unless derived. """
+        files = []
+        for m in region.media:
+            if m.type in ('image', 'video'):
+                path = "%s/%s" % (save_dir, m.options.get('uri'))
+                files.append(media_catalog(save_dir).derivative(path) if derived and 'image' == m.type else path)
+            elif not ('webpage' == m.type and 'native' == m.render):
+                files.append("%s/%s_%s_%s.html" % (save_dir, layout_id, region.id, m.id))
+        return files
+
+    def set_layout(self, layout_id, schedule_id):
+        """ Carry this region over to another layout, keep it playing. """
+        self._layout_id = layout_id
+        self._schedule_id = schedule_id
+        for view in self._media_view:
+            view.set_layout(layout_id, schedule_id)
+
+    def can_patch(self, region):
+        geometry = QRect(
+            int(float(region.left)), int(float(region.top)),
+            int(float(region.width)), int(float(region.height))
+        )
+        # the items of the running media keep their z value, a new stacking needs a new region
+        zindex = int(float(region.zindex or 0))
+        return region.id == self._id and geometry == self._geometry and zindex == self._zindex
+
+    def patch(self, region):
+        """ Swap to the media of an edited region at the next item boundary. """
+        self.signature = RegionView.signature_of(region, self._layout_id)
+        self._pending = region
+        if not any(view.is_playing() for view in self._media_view):
+            self._apply_pending()
+            self.play()
+
+    def _apply_pending(self):
+        region = self._pending
+        self._pending = None
+        for view in self._media_view:
+            if view.is_playing():
+                view.stop()
+            view.dispose()
+
+        self._media = region.media
+        self._options = region.options
+        self._loop = False
+        if 'loop' in self._options:
+            self._loop = bool(int(self._options['loop']))
+        self._media_index = 0
+        self._media_length = 0
         self._populate_media()
 
     def _populate_media(self):
         self._media_view = []
 
         for media in self._media:
-            media['_layout_id'] = self._layout_id
-            media['_schedule_id'] = self._schedule_id
-            media['_region_id'] = self._id
-            media['_save_dir'] = self._save_dir
-            media['_geometry'] = QRect(
-                int(float(self._left)), int(float(self._top)),
-                int(float(self._width)), int(float(self._height))
-            )
-            view = MediaView.make(media, self._parent)
+            view = MediaView.make(media, self, self._parent)
+            if view is None:
+                continue
+            view.started_signal.connect(lambda v=view: self._media_started(v))
             view.finished_signal.connect(self.play_next)
             self._media_view.append(view)
             self._media_length += 1
@@ -313,9 +987,41 @@ class RegionView:
     def play(self):
         if self._stop or self._media_length < 1:
             return None
+        self._requested_at = time.time()
         self._media_view[self._media_index].play()
+        self._prefetch_next()
+
+    def prepare(self):
+        """ Warm up the first item hidden, play() then shows it. """
+        if self._media_length > 0:
+            self._media_view[self._media_index].prepare()
+
+    def _prefetch_next(self):
+        index = self._media_index + 1
+        if self._loop and index >= self._media_length:
+            index = 0
+        if index < self._media_length:
+            self._media_view[index].prefetch()
+
+    def _media_started(self, view):
+        first_pixel()
+        if 'image' != view.media_type:
+            self.last_pixmap = None
+        now = time.time()
+        if self._requested_at:
+            metrics.observe('xibo_media_first_frame_seconds', now - self._requested_at, type=view.media_type)
+            self._requested_at = 0
+        if self._finished_at:
+            metrics.observe('xibo_media_gap_seconds', now - self._finished_at, region=self._id,
+                            type=view.media_type)
+            self._finished_at = 0
 
     def play_next(self):
+        self._finished_at = time.time()
+        if self._pending is not None:
+            self._apply_pending()
+            return self.play()
+
         self._media_index += 1
         if self._loop:
             if self._media_index >= self._media_length:
@@ -328,7 +1034,12 @@ class RegionView:
         self._stop = True
         for view in self._media_view:
             if view.is_playing():
-                view.stop(delete_widget=True)
+                view.stop()
+            view.dispose()
+        if self._player:
+            self._player.dispose()
+            self._player = None
+        self.last_pixmap = None
 
         del self._media_view[:]
 
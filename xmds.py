@@ -1,4 +1,5 @@
 import base64
+import copy
 import exceptions
 import logging
 import os
@@ -6,8 +7,6 @@ import re
 import sys
 import uuid
 from hashlib import md5
-from suds import WebFault as SoapFault
-from suds.client import Client as SoapClient
 from xml.etree import ElementTree
 
 logging.basicConfig(level=logging.ERROR)
@@ -16,14 +15,43 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
+# the first ones keep the hardware key of displays registered before sysfs was read
+_PREFERRED_IFACES = ('eth0', 'wlan0', 'en0')
+
+
+def _sysfs_getnode(root='/sys/class/net'):
+    """ Mac address of the first real network interface as an int, without running ifconfig.
+
+    Virtual interfaces (lo, bridges, docker, veth) have no device link, and
+    random macs are locally administered, both change from boot to boot.
+    """
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return None
+    names.sort(key=lambda n: (_PREFERRED_IFACES.index(n) if n in _PREFERRED_IFACES else len(_PREFERRED_IFACES), n))
+    for name in names:
+        if not os.path.exists(os.path.join(root, name, 'device')):
+            continue
+        try:
+            with open(os.path.join(root, name, 'address')) as f:
+                node = int(f.read().strip().replace(':', ''), 16)
+        except (IOError, ValueError):
+            continue
+        if node and not node & 0x020000000000:
+            return node
+    return None
+
+
 class Client:
-    def __init__(self, url, ver=4):
+    def __init__(self, url, ver=4, screen=0):
         self.__keys = {
             'server': '',
             'hardware': ''
         }
         self.__url = url
         self.__ver = ver
+        self.__screen = screen
         self.__mac_address = None
         self.__client = None
         self.__set_identity()
@@ -37,8 +65,9 @@ class Client:
                 if node:
                     break
         else:
-            # Linux only, find mac address using ifconfig command. taken from uuid._ifconfig_getnode
-            for args in ('eth0', 'wlan0', 'en0'):  # TODO: other possible network interface name
+            node = _sysfs_getnode()
+            # no sysfs, find mac address using ifconfig command. taken from uuid._ifconfig_getnode
+            for args in _PREFERRED_IFACES if node is None else ():
                 node = uuid._find_mac('ifconfig', args, ['hwaddr', 'ether'], lambda i: i + 1)
                 if node:
                     break
@@ -47,6 +76,9 @@ class Client:
             raise RuntimeError("No network interface found.")
         self.__mac_address = ':'.join([str('%012x' % node)[x:x + 2] for x in range(0, 12, 2)])
         url = 'xiboside://%s/%s/%s' % (sys.platform, os.name, self.__mac_address)
+        if self.__screen:
+            # every screen of a multi screen player is a display of its own
+            url += '/%d' % self.__screen
         self.__keys['hardware'] = uuid.uuid3(uuid.NAMESPACE_URL, url)
 
     @property
@@ -57,6 +89,7 @@ class Client:
         return self.__client and self.__client.wsdl is not None
 
     def connect(self):
+        from suds.client import Client as SoapClient
         try:
             self.__client = SoapClient(self.__url + "/xmds.php?WSDL&v=" + str(self.__ver))
         except exceptions.IOError, err:
@@ -65,10 +98,19 @@ class Client:
 
         return self.__client is not None
 
+    def clone(self):
+        """ A client of the same display sharing the WSDL, for use from another thread. """
+        clone = copy.copy(self)
+        clone.__keys = dict(self.__keys)
+        if self.__client is not None:
+            clone.__client = self.__client.clone()
+        return clone
+
     def set_keys(self, server_key=None):
         self.__keys['server'] = server_key
 
     def send_request(self, method=None, params=None):
+        from suds import WebFault as SoapFault
         if not self.was_connected():
             self.connect()
             return None
@@ -121,6 +163,12 @@ class Client:
                                                          params.dumps())
                 tmp = SuccessResponse()
 
+            elif 'submitScreenShot'.lower() == method.lower():
+                # params: the jpeg bytes
+                text = self.__client.service.SubmitScreenShot(self.__keys['server'], self.__keys['hardware'],
+                                                              base64.b64encode(params))
+                tmp = SuccessResponse()
+
         except SoapFault as err:
             log.error(err)
         except exceptions.IOError as err:
@@ -230,6 +278,10 @@ class RequiredFilesEntry:
         self.updated = 0
 
 
+# id="..." must not run past its closing quote, entries may share one line.
+_RESOURCE_ID = re.compile(r'(type="resource")(\s+id="[^"]*")(\s+layout)')
+
+
 class RequiredFilesResponse(_XmdsResponse):
     def __init__(self):
         super(RequiredFilesResponse, self).__init__()
@@ -242,11 +294,7 @@ class RequiredFilesResponse(_XmdsResponse):
         # Remove id attribute for resource file, seems unrelated but always change.
         # doing this we can compute md5sum of the response then save a cache of this
         # response. see XmdsThread.__xmds_cycle
-        text = re.sub(
-            r'(type="resource")(\s+id=".*")(\s+layout)',
-            r'\1\3',
-            text
-        )
+        text = _RESOURCE_ID.sub(r'\1\3', text)
 
         root = ElementTree.fromstring(text)
         if 'files' != root.tag:
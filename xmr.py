@@ -42,5 +42,6 @@ class Subscriber:
                     break
 
     def stop(self):
-        self._push.send(self._stop_command)
+        if self._push:
+            self._push.send(self._stop_command)
 
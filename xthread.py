@@ -1,45 +1,94 @@
 import base64
-import calendar
+import json
 import logging
 import os
+import threading
 import time
 from hashlib import md5
+from multiprocessing.pool import ThreadPool
 
 from PySide.QtCore import QThread
 from PySide.QtCore import Signal
 from PySide.QtCore import Slot
 
 import util
+import xlf
+from catalog import media_catalog
+from peers import peers
 import xmds
-import xmr
 
-from Crypto.PublicKey import RSA
+
+class SharedDownloads(object):
+    """ Download state shared by the XmdsThreads of all screens of the process.
+
+    A file of the common saveDir is fetched by one thread at a time, the
+    others find it done, and every running thread announces the download.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._fetched = {}
+        self._threads = []
+
+    def lock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def fetched_since(self, path, since):
+        with self._lock:
+            return self._fetched.get(path, 0) >= since
+
+    def mark_fetched(self, path):
+        with self._lock:
+            self._fetched[path] = time.time()
+
+    def register(self, thread):
+        with self._lock:
+            if thread not in self._threads:
+                self._threads.append(thread)
+
+    def unregister(self, thread):
+        with self._lock:
+            if thread in self._threads:
+                self._threads.remove(thread)
+
+    def threads(self):
+        with self._lock:
+            return list(self._threads)
+
+
+shared_downloads = SharedDownloads()
 
 
 class XmdsThread(QThread):
     log = logging.getLogger('xiboside.XmdsThread')
     downloading_signal = Signal(str, str)
-    downloaded_signal = Signal(object)
+    content_updated_signal = Signal(object)
     layout_signal = Signal(str, str, tuple)
+    next_layout_signal = Signal(str, str, tuple)
 
-    def __init__(self, config, parent):
+    def __init__(self, config, parent, screen=0):
         super(XmdsThread, self).__init__(parent)
         self.config = config
+        self.screen = screen
         self.__mac_address = None
         self.__hardware_key = None
         self.__xmds_stop = False
         self.__xmds_running = False
-        self.__xmr_pubkey = ''
-        self.__xmr_channel = ''
+        self.__xmr = None
         self.__ss_param = None
+        # files of the last RequiredFiles pass that are not up to date on disk
+        self.__stale = frozenset()
         self.single_shot = False
         self.layout_id = '0'
         self.schedule_id = '0'
         self.layout_time = (0, 0)
         if not os.path.isdir(config.saveDir):
             os.mkdir(config.saveDir, 0o700)
-        self.xmdsClient = xmds.Client(config.url)
-        self.xmdsClient.set_keys(config.serverKey)
+        self.__catalog = media_catalog(config.saveDir, config.mplayer)
+        # built in the thread, it finds the mac address and fetches the wsdl
+        self.xmdsClient = None
+        self.__local = threading.local()
         self.log.setLevel(logging.ERROR)
 
     def __enter__(self):
@@ -59,157 +108,292 @@ class XmdsThread(QThread):
         self.log.info('stop() stopped')
         self.quit()
 
+    def __client(self):
+        if self.xmdsClient is None:
+            try:
+                client = xmds.Client(self.config.url, screen=self.screen)
+            except RuntimeError, err:
+                self.log.error(err)
+                return None
+            client.set_keys(self.config.serverKey)
+            self.xmdsClient = client
+        return self.xmdsClient
+
+    def __wait(self, seconds):
+        until = time.time() + float(seconds)
+        while time.time() < until and not self.__xmds_stop:
+            self.msleep(250)
+
+    def __cache_path(self, name):
+        # the first screen keeps the file names of a single screen player
+        if self.screen:
+            base, ext = os.path.splitext(name)
+            name = '%s-%d%s' % (base, self.screen, ext)
+        return self.config.saveDir + '/' + name
+
     def __str_to_epoch(self, time_str):
-        seconds = calendar.timegm(time.strptime(time_str, self.config.strTimeFmt))
-        return seconds - self.config.cmsTzOffset
+        return util.str_to_epoch(time_str, self.config.strTimeFmt, self.config.cmsTzOffset)
 
     def __epoch_to_str(self, time_str):
-        seconds = float(time_str)
-        return time.strftime(self.config.strTimeFmt, time.gmtime(seconds + self.config.cmsTzOffset))
+        return util.epoch_to_str(time_str, self.config.strTimeFmt, self.config.cmsTzOffset)
 
-    def __submit_stats(self):
-        if isinstance(self.__ss_param, xmds.SubmitStatsParam):
-            cl = self.xmdsClient
-            resp = cl.send_request('SubmitStats', self.__ss_param)
-            success = xmds.SuccessResponse().parse(resp)
-            if success:
-                self.__ss_param = None
+    def __send(self, method, params=None):
+        # suds clients are not thread safe, each pool thread has its own clone
+        cl = getattr(self.__local, 'client', None)
+        if cl is None:
+            cl = self.__local.client = self.xmdsClient.clone()
+        return cl.send_request(method, params)
+
+    def __submit_stats(self, param):
+        resp = self.__send('SubmitStats', param)
+        success = xmds.SuccessResponse().parse(resp)
+        if success and self.__ss_param is param:
+            self.__ss_param = None
 
     def __download(self, req_file_entry=None):
+        """ Download what changed, True when every file is complete. """
         if not req_file_entry or not req_file_entry.files:
-            return None
+            return True
 
         cl = self.xmdsClient
         self.__is_downloading = True
-        get_resource_param = xmds.GetResourceParam()
-        get_file_param = xmds.GetFileParam()
+        started = time.time()
+        changes = []
+        complete = True
+        stale = set(filter(None, (self.__entry_path(entry) for entry in req_file_entry.files)))
         for entry in req_file_entry.files:
             if self.__xmds_stop:
+                complete = False
                 break
 
-            resp = None
-            file_path = None
-            downloaded = False
-            if 'resource' == entry.type:
-                file_path = "{0}/{1}_{2}_{3}{4}".format(self.config.saveDir,
-                                                        entry.layoutid, entry.regionid,
-                                                        entry.mediaid, self.config.res_file_ext)
-
-                param = get_resource_param
-                param.layoutId = entry.layoutid
-                param.regionId = entry.regionid
-                param.mediaId = entry.mediaid
-                # print 'Downloading {0}'.format(file_path)
-                self.downloading_signal.emit(entry.type, file_path)
-                resp = cl.send_request('GetResource', param)
-                if resp:
-                    try:
-                        with open(file_path, 'wb') as f:
-                            f.write(resp.content)
-                            f.flush()
-                            os.fsync(f.fileno())
-                            downloaded = True
-                    except IOError:
-                        self.log.error('Download failed: %s' % file_path)
-            elif entry.type in ('media', 'layout'):
-                file_ext = ''
-                if 'layout' == entry.type:
-                    file_ext = self.config.layout_file_ext
-                file_path = self.config.saveDir + '/' + entry.path + file_ext
-                if md5sum_match(file_path, entry.md5):
-                    # print 'Skipping {0}, md5sum match'.format(file_path)
+            file_path = self.__entry_path(entry)
+            if file_path is None:
+                continue
+            with shared_downloads.lock(file_path):
+                # another screen may have fetched it while this one waited
+                if shared_downloads.fetched_since(file_path, started):
+                    stale.discard(file_path)
                     continue
-                param = get_file_param
-                param.fileId = entry.id
-                param.fileType = entry.type
-                self.downloading_signal.emit(entry.type, file_path)
-
-                try:
-                    with open(file_path, 'wb') as f:
-                        for offset in range(0, int(float(entry.size)), 1024*1024*2):
-                            param.chuckSize = str(1024*1024*2)
-                            param.chunkOffset = str(offset)
-                            resp = cl.send_request('GetFile', param)
-                            if resp:
-                                f.write(resp.content)
-                                f.flush()
-                                os.fsync(f.fileno())
-                                downloaded = True
-                except IOError:
-                    self.log.error('Download failed: %s' % file_path)
+                downloaded = self.__download_entry(cl, entry, file_path)
+                if downloaded:
+                    shared_downloads.mark_fetched(file_path)
 
+            if downloaded is None:
+                complete = False
+            else:
+                stale.discard(file_path)
             if downloaded:
-                self.downloaded_signal.emit(entry)
+                if 'layout' == entry.type:
+                    # parse here, so the gui thread never has to
+                    xlf.layout_cache.load(file_path)
+                elif 'media' == entry.type:
+                    self.__catalog.probe(file_path, entry.md5)
+                changes.append(entry)
         # for entry ...
+        self.__stale = frozenset(stale)
+        self.__derive_images(req_file_entry)
+        self.__catalog.save()
+        # one notification for the whole change set, not one per file
+        if changes:
+            for thread in shared_downloads.threads() or [self]:
+                thread.content_updated_signal.emit(changes)
+        return complete
+
+    def __derive_images(self, req_file_entry):
+        """ Scale images down to the largest region of the layouts showing them. """
+        sizes = {}
+        for entry in req_file_entry.files:
+            if 'layout' != entry.type or self.__xmds_stop:
+                continue
+            layout = xlf.layout_cache.get(self.__entry_path(entry))
+            for region in layout.regions if layout else ():
+                for media in region.media:
+                    uri = media.options.get('uri')
+                    if 'image' == media.type and uri:
+                        width, height = sizes.get(uri, (0, 0))
+                        sizes[uri] = (max(width, int(float(region.width))), max(height, int(float(region.height))))
+        for uri, (width, height) in sizes.iteritems():
+            if self.__xmds_stop:
+                break
+            if width > 0 and height > 0:
+                self.__catalog.derive(uri, width, height)
+
+    def __entry_path(self, entry):
+        if 'resource' == entry.type:
+            return "{0}/{1}_{2}_{3}{4}".format(self.config.saveDir, entry.layoutid, entry.regionid,
+                                               entry.mediaid, self.config.res_file_ext)
+        elif entry.type in ('media', 'layout'):
+            file_ext = ''
+            if 'layout' == entry.type:
+                file_ext = self.config.layout_file_ext
+            return self.config.saveDir + '/' + entry.path + file_ext
+        return None
+
+    def __download_entry(self, cl, entry, file_path):
+        """ True when downloaded, False when already up to date, None when it failed. """
+        # written aside and renamed once complete, a view never reads half a file
+        tmp_path = file_path + '.part'
+        if 'resource' == entry.type:
+            param = xmds.GetResourceParam()
+            param.layoutId = entry.layoutid
+            param.regionId = entry.regionid
+            param.mediaId = entry.mediaid
+            # print 'Downloading {0}'.format(file_path)
+            self.downloading_signal.emit(entry.type, file_path)
+            resp = cl.send_request('GetResource', param)
+            if not resp:
+                return None
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(resp.content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, file_path)
+            except (IOError, OSError):
+                self.log.error('Download failed: %s' % file_path)
+                self.__remove(tmp_path)
+                return None
+            return True
+
+        # probed with this md5 and unchanged since, no need to read it all again
+        if 'media' == entry.type and entry.md5:
+            info = self.__catalog.get(file_path)
+            if info and info.get('md5') == entry.md5:
+                return False
+        if util.md5sum_match(file_path, entry.md5):
+            # print 'Skipping {0}, md5sum match'.format(file_path)
+            if 'media' == entry.type and not self.__catalog.has(file_path):
+                self.__catalog.probe(file_path, entry.md5)
+            return False
+        self.downloading_signal.emit(entry.type, file_path)
+        # a player of the LAN that has it saves the trip to the CMS
+        if 'media' == entry.type and peers.fetch(entry.md5, file_path):
+            return True
+        param = xmds.GetFileParam()
+        param.fileId = entry.id
+        param.fileType = entry.type
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                for offset in range(0, int(float(entry.size)), 1024*1024*2):
+                    param.chuckSize = str(1024*1024*2)
+                    param.chunkOffset = str(offset)
+                    resp = cl.send_request('GetFile', param)
+                    if not resp:
+                        raise IOError('no chunk at offset %d' % offset)
+                    f.write(resp.content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, file_path)
+        except (IOError, OSError):
+            self.log.error('Download failed: %s' % file_path)
+            self.__remove(tmp_path)
+            return None
+        return True
+
+    @staticmethod
+    def __remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
     def __xmds_cycle(self):
         self.__xmds_running = True
         self.__xmds_stop = False
-        cl = self.xmdsClient
+        shared_downloads.register(self)
         param = xmds.RegisterDisplayParam()
-        param.xmrChannel = self.__xmr_channel
-        param.xmrPubKey = self.__xmr_pubkey
+        if self.screen:
+            param.name = '%s-%d' % (param.name, self.screen + 1)
         sched_resp = xmds.ScheduleResponse()
-        sched_cache = self.config.saveDir + '/schedule.xml'
-        rf_cache = self.config.saveDir + '/rf.xml'
+        sched_cache = self.__cache_path('schedule.xml')
+        rf_cache = self.__cache_path('rf.xml')
         collect_interval = 5
+        xmr_deadline = time.time() + 30
+        # RegisterDisplay, RequiredFiles, Schedule and SubmitStats don't depend on each other
+        pool = ThreadPool(max(1, self.config.xmdsConcurrency))
         while not self.__xmds_stop:
             self.log.info('__xmds_cycle started')
-            display = cl.send_request('RegisterDisplay', param)
-
+            cl = self.__client()
+            if cl is None:
+                if self.single_shot:
+                    break
+                self.__wait(collect_interval)
+                continue
+            if self.__xmr is not None and not param.xmrPubKey:
+                # an xmr that failed to start must not keep the display from registering,
+                # it is waited for once then picked up by a later cycle if it comes up
+                while not self.__xmr.wait_ready(0.25) and not self.__xmds_stop and time.time() < xmr_deadline:
+                    pass
+                if self.__xmds_stop:
+                    break
+                if self.__xmr.wait_ready(0):
+                    param.xmrChannel = self.__xmr.channel
+                    param.xmrPubKey = self.__xmr.pubkey
+                elif xmr_deadline:
+                    self.log.error('xmr not ready, registering without it')
+                    xmr_deadline = 0
+            display = pool.apply_async(self.__send, ('RegisterDisplay', param))
+            rf = pool.apply_async(self.__send, ('RequiredFiles',))
+            schedule = pool.apply_async(self.__send, ('Schedule',))
+            stats = None
+            if isinstance(self.__ss_param, xmds.SubmitStatsParam):
+                stats = pool.apply_async(self.__submit_stats, (self.__ss_param,))
+
+            # results are handled in this order whatever order they arrive in
+            display = display.get()
             if isinstance(display, xmds.RegisterDisplayResponse):
                 if 'READY' == display.code:
                     collect_interval = display.details.get('collectInterval', 5)
 
-            rf = cl.send_request('RequiredFiles')
-            if isinstance(rf, xmds.RequiredFilesResponse):
-                if not md5sum_match(rf_cache, rf.content_md5sum()):
-                    rf.save_as(rf_cache)
-                    self.__download(rf)
-
-            schedule = cl.send_request('Schedule')
+            schedule = schedule.get()
             if isinstance(schedule, xmds.ScheduleResponse):
-                if not md5sum_match(sched_cache, schedule.content_md5sum()):
+                if not util.md5sum_match(sched_cache, schedule.content_md5sum()):
                     schedule.save_as(sched_cache)
             else:
                 if sched_resp.parse_file(sched_cache):
                     schedule = sched_resp
 
-            schedule_found = False
-            if schedule and schedule.layouts:
-                for layout in schedule.layouts:
-                    from_time = self.__str_to_epoch(layout.fromdt)
-                    to_time = self.__str_to_epoch(layout.todt)
-                    now_time = time.time()
-                    if from_time <= now_time <= to_time:
-                        self.layout_id = layout.file
-                        self.schedule_id = layout.scheduleid
-                        self.layout_time = (from_time, to_time)
-                        schedule_found = True
-                        break  # simultaneous scheduled layout is not supported yet
-                        #  ----+ stop on first scheduled layout
-                # for layout ...
-            # if schedule.layouts ...
-            if schedule and not schedule_found:
-                """ play default layout """
-                self.layout_id = schedule.layout
-                self.schedule_id = None
-                self.layout_time = (0, 0)
-            self.log.debug('emitting layout_sig(%s, %s, (%d, %d))' %
-                           (self.layout_id, self.schedule_id, self.layout_time[0], self.layout_time[1]))
-            self.layout_signal.emit(self.layout_id, self.schedule_id, self.layout_time)
-            self.__submit_stats()
+            next_layout = None
+            if schedule:
+                self.layout_id, self.schedule_id, self.layout_time = self.select_layout(schedule)
+                next_layout = self.select_next(schedule)
+            # a layout that is already here is played without waiting for the downloads
+            layout_path = self.config.saveDir + '/' + self.layout_id + self.config.layout_file_ext
+            emitted = xlf.layout_cache.get(layout_path) is not None
+            if emitted:
+                self.__emit_layout(next_layout)
+
+            rf = rf.get()
+            if isinstance(rf, xmds.RequiredFilesResponse):
+                # kept until every file is there, an incomplete set is tried again next cycle
+                if not util.md5sum_match(rf_cache, rf.content_md5sum()) and self.__download(rf):
+                    rf.save_as(rf_cache)
+
+            if not emitted:
+                xlf.layout_cache.get(layout_path)
+                self.__emit_layout(next_layout)
+            if stats:
+                stats.get()
             if self.single_shot:
                 break
-            next_collect_time = time.time() + float(collect_interval)
-            while time.time() < next_collect_time and not self.__xmds_stop:
-                self.msleep(250)
+            self.__wait(collect_interval)
         # while not ...
+        pool.close()
+        pool.join()
+        shared_downloads.unregister(self)
         self.__xmds_running = False
         self.log.info('__xmds_cycle() finished')
         if self.single_shot:
             self.quit()
 
+    def __emit_layout(self, next_layout):
+        self.log.debug('emitting layout_sig(%s, %s, (%d, %d))' %
+                       (self.layout_id, self.schedule_id, self.layout_time[0], self.layout_time[1]))
+        self.layout_signal.emit(self.layout_id, self.schedule_id, self.layout_time)
+        if next_layout:
+            self.next_layout_signal.emit(*next_layout)
+
     def run(self):
         if not self.__xmds_running:
             self.__xmds_cycle()
@@ -219,9 +403,54 @@ class XmdsThread(QThread):
     #     self.stop()
     #     return super(XmdsThread, self).quit()
 
-    def set_xmr_info(self, channel, pubkey):
-        self.__xmr_channel = channel
-        self.__xmr_pubkey = pubkey
+    def select_layout(self, schedule, now_time=None):
+        """ (layout_id, schedule_id, (from, to)) to play now according to a ScheduleResponse. """
+        if now_time is None:
+            now_time = time.time()
+        for layout in schedule.layouts:
+            from_time = self.__str_to_epoch(layout.fromdt)
+            to_time = self.__str_to_epoch(layout.todt)
+            if from_time <= now_time <= to_time:
+                # simultaneous scheduled layout is not supported yet, stop on first scheduled layout
+                return layout.file, layout.scheduleid, (from_time, to_time)
+        # play default layout
+        return schedule.layout, None, (0, 0)
+
+    def select_next(self, schedule):
+        """ The scheduled layout that starts next, if it is not the one playing now. """
+        now_time = time.time()
+        starts = [t for t in (self.__str_to_epoch(layout.fromdt) for layout in schedule.layouts) if t > now_time]
+        if not starts:
+            return None
+        start = min(starts)
+        # the one starting then, not one still running at that second (back to back, to is inclusive)
+        for layout in schedule.layouts:
+            if self.__str_to_epoch(layout.fromdt) == start:
+                next_layout = layout.file, layout.scheduleid, (start, self.__str_to_epoch(layout.todt))
+                break
+        if next_layout[0] == self.select_layout(schedule, now_time)[0]:
+            return None
+        return next_layout
+
+    def cached_layout(self):
+        """ The layout to play now according to the last saved schedule, None without one. """
+        schedule = xmds.ScheduleResponse()
+        if not schedule.parse_file(self.__cache_path('schedule.xml')):
+            return None
+        return self.select_layout(schedule)
+
+    def stale_files(self):
+        """ Paths required by the CMS that the last download pass did not bring up to date. """
+        return self.__stale
+
+    def set_xmr(self, xmr_thread):
+        self.__xmr = xmr_thread
+
+    def submit_screenshot(self, data):
+        """ Upload jpeg bytes, blocks the calling thread (not the gui one) until the cms answers. """
+        if self.xmdsClient is None:
+            return False
+        return self.__send('SubmitScreenShot', data) is not None
 
     def queue_stats(self, type_, from_date, to_date, schedule_id, layout_id, media_id):
         if self.__ss_param is None:
@@ -240,21 +469,31 @@ class XmdsThread(QThread):
 class XmrThread(QThread):
     log = logging.getLogger('xiboside.XmrThread')
     message_signal = Signal(list)
+    screenshot_signal = Signal()
 
-    def __init__(self, config, parent):
+    def __init__(self, config, parent, screen=0):
         super(XmrThread, self).__init__(parent)
         self._config = config
-        self._channel = ''
+        self._channel = md5("%d %s %d" % (time.time(), self._config.xmrPubUrl, screen)).hexdigest()
         self._pubkey = ''
         self._privkey = ''
-        self._prepare_keys()
-        self.__sub = xmr.Subscriber(self._config.xmrPubUrl, self._channel, self._handle_message)
+        self._ready = threading.Event()
+        self.__sub = None
 
     def run(self):
+        # key generation and zmq are slow to set up, keep them off the gui thread
+        import xmr
+        self._prepare_keys()
+        self.__sub = xmr.Subscriber(self._config.xmrPubUrl, self._channel, self._handle_message)
+        self._ready.set()
         self.__sub.run()
 
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
     def stop(self):
-        self.__sub.stop()
+        if self.__sub:
+            self.__sub.stop()
 
     def _handle_message(self, messages):
         if messages[0] == '':
@@ -265,14 +504,22 @@ class XmrThread(QThread):
     def _decrypt_message(self, messages):
         sealed_data = base64.decodestring(messages[1])
         env_key = base64.decodestring(messages[0])
-        # TODO: just print the decrypted message for now
-        print util.openssl_open(sealed_data, env_key, self._privkey)
+        text = util.openssl_open(sealed_data, env_key, self._privkey)
+        try:
+            action = json.loads(text).get('action')
+        except (TypeError, ValueError, AttributeError):
+            self.log.error('Unreadable xmr message')
+            return
+        if 'screenShot' == action:
+            self.screenshot_signal.emit()
+        else:
+            self.log.info('xmr action %s not supported' % action)
 
     def _prepare_keys(self):
+        from Crypto.PublicKey import RSA
         rsa = RSA.generate(2048)
         self._privkey = rsa.exportKey()
         self._pubkey = rsa.publickey().exportKey()
-        self._channel = md5("%d %s" % (time.time(), self._config.xmrPubUrl)).hexdigest()
 
     @property
     def pubkey(self):
@@ -281,21 +528,3 @@ class XmrThread(QThread):
     @property
     def channel(self):
         return self._channel
-
-
-def md5sum_match(file_path, md5sum):
-    if not os.path.isfile(file_path):
-        return False
-
-    f = None
-    content = None
-    try:
-        f = open(file_path, 'rb')
-    finally:
-        if f:
-            content = f.read()
-        f.close()
-    if not content:
-        return False
-
-    return md5(content).hexdigest() == md5sum